@@ -1,6 +1,9 @@
 from pathlib import Path
-from collections import defaultdict
+from collections import defaultdict, namedtuple, deque
 import re
+import posixpath
+from functools import partial
+from concurrent.futures import Future
 import time
 import torch
 import webdataset as wds
@@ -13,22 +16,22 @@ from TexSoup.data import TexMathModeEnv, TexEnv, TexCmd, TexText, TexGroup, Brac
 import os
 import tarfile
 import fsspec
-from pdf2image import convert_from_bytes
-from latex_render import latex2image, latex2imagev2
-import objgraph
-
-from pympler.tracker import SummaryTracker
-from pympler import summary, muppy  
-
-from pympler.classtracker import ClassTracker
-from pympler import web
-
-from mem_top import mem_top
+from rasterize import get_rasterizer, POSTSCRIPT_EXTENSIONS
+from compositing import composite, encode
+from image_probe import probe
+from latex_render import latex2image, latex2imagev2, render_batch, RENDER_SETTINGS
+from render_cache import get_render_cache
+from equation_filter import get_equation_filter
+import tex_parser
+from tex_project import resolve_project
+from guard import guarded, BudgetExceeded
+from metrics import timer, count, stats_record
 
 class ArxivFigureCaptions(torch.utils.data.IterableDataset):
 
-    def __init__(self, filelist, start=None, end=None):
+    def __init__(self, filelist, start=None, end=None, extract=("figure_captions",)):
         super().__init__()
+        self.extract = list(extract)
         if start is None and end is None:
             start = 0
             end = len(filelist)
@@ -40,17 +43,20 @@ class ArxivFigureCaptions(torch.utils.data.IterableDataset):
     def __iter__(self):
         for fs in self.filelist[self.start:self.end]:
             try:
-                yield from parse_arxiv_shard_tar(fs, extract=["figure_captions"])
+                yield from parse_arxiv_shard_tar(fs, extract=self.extract)
             except Exception as ex:
                 print(ex)
+            # static datasets are not wrapped in `scheduler.tag_source`, their metrics are sent here
+            yield stats_record()
 
     def __len__(self):
         return len(self.filelist[self.start:self.end])
 
 class ArxivEquations(torch.utils.data.IterableDataset):
 
-    def __init__(self, filelist, start=None, end=None):
+    def __init__(self, filelist, start=None, end=None, render_cache=None):
         super().__init__()
+        self.render_cache = render_cache
         if start is None and end is None:
             start = 0
             end = len(filelist)
@@ -62,30 +68,95 @@ class ArxivEquations(torch.utils.data.IterableDataset):
     def __iter__(self):
         for fs in self.filelist[self.start:self.end]:
             try:
-                yield from parse_arxiv_shard_tar(fs, extract=["math"])
+                yield from parse_arxiv_shard_tar(fs, extract=["math"], render_cache=self.render_cache)
             except Exception as ex:
                 print(ex)
+            yield stats_record()
     def __len__(self):
         return len(self.filelist[self.start:self.end])
 
-#tracker = SummaryTracker()
+# yielded (and filtered out by `lookahead_papers`) by `parse_arxiv_paper_tar_gz` once the figures
+# of the paper are submitted to the rasterizer
+FIGURES_SUBMITTED = object()
 
-def parse_arxiv_shard_tar(path, extract=["figure_captions"]):
+
+def parse_arxiv_shard_tar(path, extract=["figure_captions"], stream=True, paper_timeout=600, paper_max_memory=None, quarantine=None, lookahead=1, **kw):
     """
     arxiv dump is divided into multiple shards (tar format),
     and in each  shard there are multiple papers
+
+    with `stream=True` the shard is read sequentially (tar stream mode `r|`) straight
+    from the fsspec file object, so each paper is handled as soon as it is downloaded
+    and only one paper at a time is held in memory (plus `lookahead` papers).
+
+    the figures of the next `lookahead` papers are submitted to the rasterizer before the samples
+    of a paper are produced, so that slow PDFs are rasterized while other papers are processed.
+
+    each paper gets `paper_timeout` seconds and `paper_max_memory` bytes of RSS growth (see `guard.Budget`): papers going over
+    their budget or raising an exception are skipped (and logged to the `quarantine` JSONL file
+    if given), and the shard goes on with the next paper.
+
+    other keyword arguments are passed to `parse_arxiv_paper_tar_gz`.
     """
+    kw = dict(kw, guard=dict(timeout=paper_timeout, max_memory=paper_max_memory, quarantine=quarantine, shard=path))
+    if not stream:
+        papers = _arxiv_papers_in_memory(path, extract=extract, **kw)
+    else:
+        papers = _arxiv_papers_stream(path, extract=extract, **kw)
+    yield from lookahead_papers(papers, lookahead)
 
-    of = None
+
+def lookahead_papers(papers, lookahead=1):
+    """
+    chain the samples of `papers` (generators of samples of each paper, see `parse_arxiv_paper_tar_gz`),
+    each paper being started (up to `FIGURES_SUBMITTED`) `lookahead` papers in advance
+    """
+    started = deque()
+    for paper in papers:
+        first = []
+        for sample in paper:
+            if sample is FIGURES_SUBMITTED:
+                break
+            first.append(sample)
+        started.append((first, paper))
+        while len(started) > lookahead:
+            first, paper = started.popleft()
+            yield from first
+            yield from (sample for sample in paper if sample is not FIGURES_SUBMITTED)
+    while started:
+        first, paper = started.popleft()
+        yield from first
+        yield from (sample for sample in paper if sample is not FIGURES_SUBMITTED)
+
+
+def _arxiv_papers_stream(path, extract=["figure_captions"], **kw):
+    # errors reading the shard are raised, so that it is not recorded as done (see `scheduler.tag_source`)
+    fd = fsspec.open(path).open()
+    nb = 0
     try:
-        of = fsspec.open(path)        
-        with of as fd:
-            data = fd.read()
-        of.close()
-    except Exception as ex:
-        print(ex)
-        of.close()
-        return
+        with tarfile.open(fileobj=fd, mode="r|") as tar:
+            for member in tar:
+                if not member.isfile() or not member.name.endswith(".gz"):
+                    continue
+                with timer("download"):
+                    f = tar.extractfile(member)
+                    data = f.read()
+                    f.close()
+                nb += 1
+                yield parse_arxiv_paper_guarded(io.BytesIO(data), member.name, extract=extract, **kw)
+                del data
+    finally:
+        fd.close()
+    print(f"End of {path}, nb of papers: {nb}")
+
+
+def parse_arxiv_paper_guarded(fd, url, guard=None, **kw):
+    return guarded(parse_arxiv_paper_tar_gz(fd, url, **kw), url, **(guard or {}))
+
+
+def _arxiv_papers_in_memory(path, extract=["figure_captions"], **kw):
+    with fsspec.open(path) as fd, timer("download"):
+        data = fd.read()
     fd = io.BytesIO(data)
     tar = tarfile.open(fileobj=fd)
     #import gc
@@ -98,53 +169,134 @@ def parse_arxiv_shard_tar(path, extract=["figure_captions"]):
             f = tar.extractfile(member)
             data = f.read()
             f.close()
-            fd_gz = io.BytesIO(data)
-            yield from parse_arxiv_paper_tar_gz(fd_gz, member.name, extract=extract)
-            fd_gz.close()
-            del fd_gz
+            yield parse_arxiv_paper_guarded(io.BytesIO(data), member.name, extract=extract, **kw)
 
     tar.close()
     fd.close()
     del fd
     print(f"End of {path}")
 
-def parse_arxiv_shard_tar_to_list(path, extract):
-    return list(parse_arxiv_shard_tar(path, extract=extract))
+def parse_arxiv_shard_tar_to_list(path, extract, stream=True, **kw):
+    return list(parse_arxiv_shard_tar(path, extract=extract, stream=stream, **kw))
+
 
+# extension resolution order of \\includegraphics when no extension is given
+GRAPHICS_EXTENSIONS = (".pdf", ".png", ".jpg", ".jpeg", ".eps", ".ps")
 
-def clean(data):
-    lines = data.split("\n")
-    lines = [l for l in lines if not l.strip().startswith("%")]
-    return "\n".join(lines)
+
+def normalize_path(path):
+    return posixpath.normpath(path.replace("\\", "/")).lstrip("/")
+
+
+class PathIndex:
+    """
+    index of the files of a paper, to resolve \\includegraphics arguments in O(1):
+    paths are normalized and looked up with or without extension, and case-insensitively
+    as a last resort
+    """
+
+    def __init__(self, filelist):
+        # normalized path -> file name
+        self.exact = {}
+        # normalized path without extension -> {extension: file name}
+        self.no_ext = {}
+        # case-folded variants come second so that they never shadow an exact path
+        for fold in (False, True):
+            for name in filelist:
+                path = normalize_path(name)
+                if fold:
+                    path = path.casefold()
+                stem, ext = posixpath.splitext(path)
+                self.exact.setdefault(path, name)
+                self.no_ext.setdefault(stem, {}).setdefault(ext.lower(), name)
+
+    def lookup(self, key):
+        if key in self.exact:
+            return self.exact[key]
+        candidates = self.no_ext.get(key)
+        if candidates:
+            for ext in GRAPHICS_EXTENSIONS:
+                if ext in candidates:
+                    return candidates[ext]
+            return next(iter(candidates.values()))
+        return None
+
+    def resolve(self, path, prefixes=("",)):
+        """
+        return the file name `path` refers to, trying each of the `prefixes` (\\graphicspath) in order
+        """
+        path = path.strip().strip('"')
+        for prefix in prefixes:
+            key = normalize_path(posixpath.join(prefix.strip(), path))
+            name = self.lookup(key)
+            if name is None:
+                name = self.lookup(key.casefold())
+            if name is not None:
+                return name
+        return None
+
+
+def graphicspath(data):
+    """
+    return the folders declared with \\graphicspath (plus the root folder)
+    """
+    prefixes = [""]
+    for paths in re.findall(r"\\graphicspath\s*\{((?:\s*\{[^{}]*\})+)\s*\}", data):
+        prefixes.extend(re.findall(r"\{([^{}]*)\}", paths))
+    return prefixes
+
+
+FIGURE_TAG = re.compile(r"\\(begin|end)\{(figure\*?)\}")
+
+
+def find_figures(data):
+    """
+    return the (start, end) offsets of the content of every figure environment of `data`
+    (starred or not, possibly nested), sorted by start, in a single pass over `data`
+    """
+    spans = []
+    # open environments, as (name, content start)
+    stack = []
+    for tag in FIGURE_TAG.finditer(data):
+        kind, name = tag.groups()
+        if kind == "begin":
+            stack.append((name, tag.end()))
+            continue
+        # close the innermost open environment with the same name
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i][0] == name:
+                spans.append((stack[i][1], tag.start()))
+                del stack[i:]
+                break
+    spans.sort()
+    return spans
+
+
+def parse_figure(fig, fast=True):
+    """
+    parse the content of a figure environment, with the lightweight parser when possible
+    and TexSoup otherwise. Both give the same tree.
+    """
+    if fast:
+        try:
+            return tex_parser.parse(fig)
+        except tex_parser.Unsupported:
+            pass
+    return TexSoup(fig)
 
 
-def extract_figure_caption_pairs(data, filelist):
+def extract_figure_caption_pairs(data, filelist, fast=True):
     """
     extract all figure-caption pairs by using a) latex file content and b) filelist of an existing paper (to extract image contents)
-    
+    `fast` uses the lightweight parser from `tex_parser` and only falls back to TexSoup when needed.
     """
-    subfolders = ['']
-    graphicspath = re.findall(r"\\graphicspath\{(\{.*?\})\}", data, flags=re.DOTALL)
-    for g in graphicspath:
-        g = g.replace('{', '')
-        g = g.replace('}', '')
-        subfolders.append(Path(g))
-    figs = re.findall(r"\\begin\{figure\*?\}(.*?)\\end\{figure(.*?)\}", data, flags=re.DOTALL)
-    filelist_no_ext = [Path(os.path.splitext(f)[0]) for f in filelist]
-    filelist_orig = filelist
-    filelist = [Path(fs) for fs in filelist]
-    # find start figure tag
-    figs_enter = re.finditer(r"\\begin\{figure\*?\}", data)
+    if not isinstance(filelist, PathIndex):
+        filelist = PathIndex(filelist)
+    subfolders = graphicspath(data)
     nb = 0
-    for fig_enter in figs_enter:
-        # find end figure tag
-        fig_close = data[fig_enter.start():fig_enter.end()].replace("\\begin", r"\\end").replace("*", r"\*")
-        text_from_fig_enter = data[fig_enter.end():]
-        match = re.search(fig_close, text_from_fig_enter, flags=re.DOTALL)
-        if not match:
-            continue
+    for fig_start, fig_end in find_figures(data):
         # inside figure content
-        fig = text_from_fig_enter[:match.start()]
+        fig = data[fig_start:fig_end]
         #if len(fig) > 2000:
         #    print("SKIP")
         #    continue
@@ -152,21 +304,13 @@ def extract_figure_caption_pairs(data, filelist):
         try:
             #print(len(fig))
             #soup = TexSoup("\\begin{figure}" + fig + "\\end{figure}")
-            soup = TexSoup(fig)
+            soup = parse_figure(fig, fast=fast)
         except Exception as ex:
             print(ex)
             continue
             
         def get_filename(f):
-            for sf in subfolders:
-                s = sf / Path(f)
-                if s in (filelist):
-                    i = filelist.index(s)
-                    fname = filelist_orig[i]
-                    return fname
-                elif s in filelist_no_ext:
-                    fname = filelist_orig[filelist_no_ext.index(s)]
-                    return fname
+            return filelist.resolve(f, subfolders)
         fnames = []
         caption = None
         subcaptions = []
@@ -193,7 +337,7 @@ def extract_figure_caption_pairs(data, filelist):
             if n.name == "subfloat":
                 local_caption = None
                 for arg in n.args:
-                    if type(arg) == BracketGroup:
+                    if arg.name == "BracketGroup":
                         local_caption = arg.string
             elif n.name == "subfigure":
                 for nn in n.children:
@@ -239,152 +383,172 @@ def extract_figure_caption_pairs(data, filelist):
                 full_caption += global_caption
             yield [name], full_caption
 
-def parse_arxiv_paper_tar_gz(fd, url, extract=("figure_captions",)):
+def parse_arxiv_paper_tar_gz(fd, url, extract=("figure_captions",), pdf_workers=4, pdf_size=1024, ghostscript=False, render_cache=None, render_cache_memory=64e6, render_workers=0, tex_fallback=False, equation_filter=None, image_format="png", image_quality=None, max_image_size=None, max_bytes=None):
     # process a single paper (usually a .tar.gz file) from a file description
+    # papers with more than `max_bytes` bytes once decompressed are stopped with `BudgetExceeded`
+    # `extract` lists the kinds of samples to produce ("figure_captions", "math"), each sample
+    # is tagged with its kind (`__kind__`) so that they can be written to separate shards
+    # PDF figures are rasterized by a pool of `pdf_workers` poppler processes, to about `pdf_size` pixels,
+    # as well as EPS/PS figures with `ghostscript`, with persistent Ghostscript processes (if Ghostscript is installed)
+    # `FIGURES_SUBMITTED` is yielded once the figures are submitted to the rasterizer, and before any sample
+    # figures made of several images are composited into a single image of at most `max_image_size` pixels
+    # (largest side) if given, encoded with `image_format` (see `compositing.CODECS`) and `image_quality`
+    # equations are rendered through a cache, kept in memory and in the `render_cache` SQLite file if given,
+    # with a pool of `render_workers` processes if > 0, those mathtext can't render are rendered with pdflatex if `tex_fallback`
+    # `equation_filter` (options of `EquationFilter`) drops equations before rendering,
+    # the number of dropped equations is yielded as a `{"__stats__": ...}` record
+    # the time spent in each stage and the figures/equations found, emitted and dropped are recorded in `metrics`
     t0 = time.time()
     try:
         tar = tarfile.open(fileobj=fd, mode='r:gz')
     except Exception as ex: 
         #print(ex)
+        count("papers_unreadable")
         return
+    count("papers")
     filelist = []
-    latex_files = []
+    tex_sources = {}
     members = {}
-    for member in tar.getmembers():
-        filelist.append(member.name)
-        if member.name.endswith(".tex"):
-            try:
-                data = (tar.extractfile(member).read()).decode()
-            except Exception as ex:
-                #print(ex)
-                continue
-            latex_files.append(data)
-        members[member.name] = member
+    total_size = 0
+    with timer("decompress"):
+        for member in tar:
+            # stop decompression bombs before they are decompressed
+            total_size += member.size
+            if max_bytes and total_size > max_bytes:
+                tar.close()
+                raise BudgetExceeded(f"more than {max_bytes:.0f} bytes decompressed")
+            filelist.append(member.name)
+            if member.name.endswith(".tex"):
+                try:
+                    data = (tar.extractfile(member).read()).decode()
+                except Exception as ex:
+                    #print(ex)
+                    continue
+                tex_sources[member.name] = data
+            members[member.name] = member
+    # the paper as a single source, shared by the extractors: its root document with the included
+    # files expanded and without comments, other .tex files are ignored
+    with timer("parse_latex"):
+        latex, tex_used = resolve_project(tex_sources)
     pairs = []
     nb = 0
+    nb_actual_imgs = 0
+    path_index = PathIndex(filelist)
+    if "figure_captions" in extract:
+        nb_actual_imgs = len(re.findall(r"\\begin\{figure", latex))
+        with timer("parse_latex"):
+            pairs.extend(list(extract_figure_caption_pairs(latex, path_index)))
+        count("figures_found", len(pairs))
+        # read all the figures first so that PDFs are rasterized in the background,
+        # while the equations of the paper and the previous papers are processed (see `lookahead_papers`)
+        rasterizer = get_rasterizer(num_workers=pdf_workers, target_size=pdf_size, ghostscript=ghostscript)
+        contents = {}
+        with timer("decompress"):
+            for img_paths, caption in pairs:
+                for img_path in img_paths:
+                    if img_path in contents or img_path not in members:
+                        continue
+                    try:
+                        data = (tar.extractfile(members[img_path]).read())
+                    except Exception as ex:
+                        print(ex)
+                        continue
+                    ext = os.path.splitext(img_path)[1].lower()
+                    if ext == ".pdf" or (ext in POSTSCRIPT_EXTENSIONS and rasterizer.ghostscript):
+                        data = rasterizer.submit(data, ext)
+                    contents[img_path] = data
+    yield FIGURES_SUBMITTED
     if "math" in extract:
-        nb_actual_imgs  = 0
-        for latex in latex_files:
-            for eq in extract_math(latex):
-                img = latex2imagev2(eq)
-                if img is not None:
-                    yield {"caption": eq, "img_content": img, "url": url, "img_path": "img.png"}
-                nb += 1
+        fallback = "pdflatex" if tex_fallback else None
+        cache = get_render_cache(render_cache, lru_bytes=render_cache_memory, settings=dict(RENDER_SETTINGS, fallback=fallback))
+        # all the equations of the paper are rendered as one batch
+        with timer("parse_latex"):
+            eqs = extract_math(latex)
+        count("equations_found", len(eqs))
+        # samples are indexed by their position before filtering, which is the same on resume (see `Manifest`);
+        # the equations kept by the filter are distinct
+        positions = {}
+        for i, eq in enumerate(eqs):
+            positions.setdefault(eq, i)
+        if equation_filter is not None:
+            eq_filter = get_equation_filter(**equation_filter)
+            nb_found = len(eqs)
+            eqs = eq_filter.filter(eqs, url)
+            count("equations_dropped_filter", nb_found - len(eqs))
+            yield {"__stats__": {"equations": nb_found, "equation_filter": dict(eq_filter.pop_counts())}}
+        with timer("render_equations"):
+            renders = cache.render_batch(eqs, partial(render_batch, num_workers=render_workers, fallback=fallback))
+        render_failed = defaultdict(int)
+        for eq, (img, cached) in zip(eqs, renders):
+            if img is not None:
+                count("equations_emitted")
+                yield {"caption": eq, "img_content": img, "url": url, "img_path": "img.png", "__render_cache__": cached, "__kind__": "math", "__index__": positions[eq]}
+            else:
+                count("equations_dropped_render_failed")
+                render_failed[cached] += 1
+            nb += 1
+        if render_failed:
+            yield {"__stats__": {"render_failed": dict(render_failed)}}
     if "figure_captions" in extract:
-        nb_actual_imgs  = 0
-        latexs = ""
-        for latex in latex_files:
-            latexs += latex
-            t0 = time.time()
-            latex = clean(latex)
-            nb_actual_imgs += len(re.findall(r"\\begin\{figure", latex))
-            pairs.extend(list(extract_figure_caption_pairs(latex, filelist)))
         #for img_path, caption in pairs:
-        for img_paths, caption in pairs:
+        for index, (img_paths, caption) in enumerate(pairs):
             imgs = []
             for img_path in img_paths:
-                if img_path not in members:
+                if img_path not in contents:
+                    count("images_dropped_missing_file")
                     continue
                 member = members[img_path]
                 name, ext = os.path.splitext(member.name)
-                try:
-                    data = (tar.extractfile(member).read())
-                except Exception as ex:
-                    print(ex)
-                    continue
+                data = contents[img_path]
                 
-                if ext == ".pdf":
-                    t0 = time.time()
-                    try:
-                        images_pil = convert_from_bytes(data)
-                    except Exception:
-                        continue
-                    if len(images_pil) != 1:
+                if isinstance(data, Future):
+                    # time spent waiting for the rasterizer, the rasterization itself is in "rasterize"
+                    with timer("rasterize_wait"):
+                        data = data.result()
+                    if data is None:
+                        count("images_dropped_rasterize_failed")
                         continue
-                    image_pil = images_pil[0]
-                    fd_image = io.BytesIO()
-                    image_pil.save(fd_image, format='PNG')
-                    data = fd_image.getvalue()
                     full_name = name + ".png"
                 else:
                     full_name = member.name
-                    try:
-                        image_pil = Image.open(io.BytesIO(data))
-                    except Exception:
-                        continue
+                # only the header is read, images are decoded if they need to be composited
+                info = probe(data)
+                if info is None:
+                    count("images_dropped_not_an_image")
+                    continue
                 if os.path.splitext(full_name)[1] == '':
+                    count("images_dropped_no_extension")
                     continue
-                imgs.append((image_pil, data, full_name))
+                imgs.append((info[1:], data, full_name))
             
             if len(imgs) == 1:
-                img, data, full_name = imgs[0]
+                (width, height), data, full_name = imgs[0]
             elif len(imgs) > 1:
-                
-                # heuristic to find if figures are concatenated horizontally or vertically
-                c = caption.lower()
-                #left_or_right = "(left)" in c or "(right)" in c or r"\textbf{left}" in c or r"\textbf(right)" in c
-                #top_or_bottom = "(top)" in c or "(bottom)" in c or  r"\textbf{top}" in c or r"\textbf(bottom)" in c
-                left_or_right = "left" in c or "right" in c
-                top_or_bottom = "top" in c or "bottom" in c
-
-                if left_or_right and top_or_bottom:
-                    horiz = True
-                elif left_or_right and not top_or_bottom:
-                    horiz = True
-                elif not left_or_right and top_or_bottom:
-                    horiz = False
-                else:                    
-                    total_width = sum(img.width for img, data, fn in imgs)
-                    max_height = max(img.height for img, data, fn in imgs)
-                    Wa = total_width
-                    Ha = max_height
-
-                    total_height = sum(img.height for img, data, fn in imgs)
-                    max_width = max(img.width for img, data, fn in imgs)
-                    Wb = max_width
-                    Hb = total_height
-
-                    if (abs(Wa/Ha-1))  <  (abs(Wb/Hb-1)):
-                        horiz = True
-                    else:
-                        horiz = False
-                if horiz:
-                    total_width = sum(img.width for img, data, fn in imgs)
-                    max_height = max(img.height for img, data, fn in imgs)
-                    new_im = Image.new('RGB', (total_width, max_height),  (255,255,255,255))
-                    x_offset = 0
-                    for img, data, fn in imgs:
-                        img = img.resize((img.width, max_height))
-                        new_im.paste(img, (x_offset,0))
-                        x_offset += img.size[0]
-                else:
-                    total_height = sum(img.height for img, data, fn in imgs)
-                    max_width = max(img.width for img, data, fn in imgs)
-                    new_im = Image.new('RGB', (max_width, total_height),  (255,255,255,255))
-                    y_offset = 0
-                    for img, data, fn in imgs:
-                        img = img.resize((max_width, img.height))
-                        new_im.paste(img, (0, y_offset))
-                        y_offset += img.size[1]
-                full_name = ""
-                for img, data, fn in imgs:
-                    full_name += fn+"_"
-                full_name += ".png"
-                fd_image = io.BytesIO()
-                new_im.save(fd_image, format='PNG')
-                data = fd_image.getvalue()
+                try:
+                    with timer("encode"):
+                        new_im = composite([data for size, data, fn in imgs], [size for size, data, fn in imgs], caption, max_size=max_image_size)
+                        data, ext = encode(new_im, image_format, image_quality)
+                except Exception as ex:
+                    print(ex)
+                    count("figures_dropped_composite_failed")
+                    continue
+                width, height = new_im.size
+                full_name = "".join(fn + "_" for size, _, fn in imgs) + ext
             else:
                 data = None
 
             if data is not None:
-                yield {"img_content": data, "caption": caption, "img_path": full_name, "url": url}
+                count("figures_emitted")
+                yield {"img_content": data, "caption": caption, "img_path": full_name, "url": url, "width": width, "height": height, "__kind__": "figure_captions", "__index__": index}
                 nb += 1
+            else:
+                count("figures_dropped_no_image")
     tar.close()
-    print(f"Finished {url} in {time.time() - t0} in {os.getpid()} with {nb} pairs, there are {nb_actual_imgs} figures")
+    print(f"Finished {url} in {time.time() - t0} in {os.getpid()} with {nb} pairs, there are {nb_actual_imgs} figures, {len(tex_used)}/{len(tex_sources)} .tex files used")
     
     if nb_actual_imgs != nb:
         with open("debug.tex", "w") as fd:
-            fd.write(latexs)
+            fd.write(latex)
         #sys.exit(0)
 
     
@@ -407,33 +571,61 @@ def node_to_string(tex_tree):
 
     return ''.join(result) if result else ''
 
-def extract_math(latex_code):
-    """
-    extract all math equations from a Tex file
+MATH_ENVIRONMENTS = ("equation", "align", "gather", "multline", "eqnarray", "flalign", "alignat", "math", "displaymath")
+VERBATIM_ENVIRONMENTS = ("verbatim", "Verbatim", "lstlisting", "minted", "comment")
+# content of delimited math: escapes, comments, and no blank line
+MATH_CONTENT = r"[^{close}\\%\n]*+(?:(?:\\{escape}[\s\S]|%[^\n]*+|\n(?![ \t]*\n){extra})[^{close}\\%\n]*+)*+"
+# a single alternation scanned once over the source: comments (those that contain a "$" or a "\", others
+# can't hide anything), escaped characters, \verb and verbatim environments are matched only to be skipped,
+# equations are in the group named after their delimiters. Unbalanced dollars are skipped too.
+# Groups: delimiter, verbatim, env, environment, bracket, paren, display, inline.
+MATH_TOKEN = re.compile(
+    r"%[^\n$\\]*+[$\\][^\n]*+"
+    r"|\\(?:[\\$%]"
+    r"|verb\*?(?P<delimiter>[^a-zA-Z\s*])[^\n]*?(?P=delimiter)"
+    r"|begin\s*\{(?:(?P<verbatim>" + "|".join(VERBATIM_ENVIRONMENTS) + r")\}[\s\S]*?\\end\{(?P=verbatim)\}"
+    r"|(?P<env>(?:" + "|".join(MATH_ENVIRONMENTS) + r")\*?)\}(?P<environment>[\s\S]*?)\\end\{(?P=env)\})"
+    r"|\[(?P<bracket>" + MATH_CONTENT.format(close="", escape=r"(?!\])", extra="") + r")\\\]"
+    r"|\((?P<paren>" + MATH_CONTENT.format(close="", escape=r"(?!\))", extra="") + r")\\\))"
+    r"|\$\$(?P<display>" + MATH_CONTENT.format(close="$", escape="", extra=r"|\$(?!\$)") + r")\$\$"
+    r"|\$(?P<inline>" + MATH_CONTENT.format(close="$", escape="", extra="") + r")\$"
+    r"|\$\$?"
+)
+# kind of equation of each group
+MATH_KINDS = {"environment": "environment", "bracket": "display", "display": "display", "paren": "inline", "inline": "inline"}
+MathSpan = namedtuple("MathSpan", ["kind", "env", "start", "end"])
+COMMENT = re.compile(r"(\\[\\%])|%[^\n]*")
+
+
+def find_math(data):
     """
-    values = re.findall(r"\$(.*?)\$", latex_code)
-    eqs = re.findall(r"\\begin\{equation\}(.*?)\\end\{equation\}", latex_code)
-    #print(len(eqs))
-    values = values + eqs
-    eqs = re.findall(r"\\begin\{math\}(.*?)\\end\{math\}", latex_code)
-    #print(len(eqs))
-    values = values + eqs
-    return values
+    find all the equations of a LaTeX source in a single pass, returns a list of `MathSpan(kind, env, start, end)`
+    where `data[start:end]` is the content of the equation and `kind` is "inline" (`$...$`, `\\(...\\)`),
+    "display" (`$$...$$`, `\\[...\\]`) or "environment" (`equation`, `align`, `gather`, ...,
+    starred or not, `env` being the name of the environment).
+    Comments, verbatim environments, `\\verb` and escaped `\\$` are skipped, as well as empty equations.
+    Delimited math can't contain a blank line, so that an unbalanced `$` is ignored instead of
+    shifting all the following equations.
     """
-    t0 = time.time()
-    soup = TexSoup(latex_code, tolerance=1)
-    print(time.time() - t0)
-    values = []
-    for node in nodes(soup):
-        if type(node.expr) == TexMathModeEnv:
-            value = node.expr.string
-        elif node.name == "math":
-            value = ''.join([n for n in node.text])
-        else:
+    spans = []
+    for m in MATH_TOKEN.finditer(data):
+        kind = MATH_KINDS.get(m.lastgroup)
+        if kind is None:
+            continue
+        start, end = m.span(m.lastgroup)
+        if not data[start:end].strip():
             continue
-        values.append(value)
-    return values
+        spans.append(MathSpan(kind, m.group("env"), start, end))
+    return spans
+
+
+def extract_math(latex_code):
+    """
+    extract all math equations from a Tex file (see `find_math`), without their comments
     """
+    # same scan as `find_math`, with `findall` so that the equations are collected without a Python loop per token
+    equations = [e or b or p or d or i for _, _, _, e, b, p, d, i in MATH_TOKEN.findall(latex_code)]
+    return [COMMENT.sub(lambda m: m.group(1) or "", eq) if "%" in eq else eq for eq in equations if eq.strip()]
 
 def nodes(s):
     """
@@ -0,0 +1,454 @@
+import io
+import os
+import re
+import signal
+import time
+import random
+from clize import run
+from PIL import Image
+
+from TexSoup import TexSoup
+
+import tex_parser
+from arxiv import find_figures, extract_figure_caption_pairs, node_to_string, nodes, extract_math
+from compositing import composite, encode, is_horizontal, layout
+from image_probe import probe
+from latex_render import render_chunk, has_tex_fallback
+from scheduler import stream_map
+
+FIGURE = r"""\begin{figure%(star)s}
+\centering
+\includegraphics[width=0.45\linewidth]{figs/plot_%(i)d}
+\caption{Results of experiment %(i)d, see Section~\ref{sec:exp}.}
+\label{fig:%(i)d}
+\end{figure%(star)s}
+"""
+
+PARAGRAPH = "Lorem ipsum dolor sit amet, consectetur adipiscing elit $x_%(i)d^2 + y$, sed do eiusmod tempor.\n"
+PAPER_PARAGRAPH = r"""As shown in Section~\ref{sec:%(i)d} and by \citet{smith%(i)d}, the loss $\mathcal{L}_{%(i)d}$ decreases
+when $\lambda \in [0, 1]$ (see Fig.~\ref{fig:%(i)d}), reaching 95\%% accuracy with \textbf{fewer} parameters
+than \emph{previous} work~\cite{a%(i)d,b%(i)d}, which relied on hand-crafted features \citep{c%(i)d}.
+%% TODO: rephrase this paragraph
+"""
+
+# display equations, most of them missed or mangled by the three regex scans
+EQUATIONS = [
+    r"""\begin{equation}
+\mathcal{L}_{%(i)d} = \sum_{j=1}^{N} \log p(x_j \mid \theta) %% negative log-likelihood
+\end{equation}
+""",
+    r"""\begin{align*}
+a_{%(i)d} &= b + c \\
+d &= \frac{e}{f}
+\end{align*}
+""",
+    "We have $$\\|w_{%(i)d}\\|_2 \\leq 1$$ and \\[ y = W x \\] for all \\$5 costs.\n",
+]
+# display equations that the three regex scans find correctly
+SIMPLE_EQUATIONS = [
+    r"""\begin{equation} E_{%(i)d} = m c^2 \end{equation}
+""",
+    r"""Inline \begin{math}a_{%(i)d} + b\end{math} in the text.
+""",
+]
+
+
+def synthetic_tex(size=5_000_000, figure_every=20, seed=0, equation_every=0, equations=EQUATIONS, paragraph=PARAGRAPH):
+    """
+    synthetic .tex source of about `size` characters, with one figure every `figure_every` paragraphs
+    (and one of `equations` every `equation_every` paragraphs if > 0)
+    """
+    rng = random.Random(seed)
+    parts = [r"\documentclass{article}" + "\n" + r"\begin{document}" + "\n"]
+    total = 0
+    i = 0
+    while total < size:
+        if i % figure_every == 0:
+            part = FIGURE % {"i": i, "star": rng.choice(["", "*"])}
+        elif equation_every and i % equation_every == 0:
+            part = rng.choice(equations) % {"i": i}
+        else:
+            part = paragraph % {"i": i}
+        parts.append(part)
+        total += len(part)
+        i += 1
+    parts.append(r"\end{document}" + "\n")
+    return "".join(parts)
+
+
+def find_figures_slicing(data):
+    # previous implementation: copies the rest of the document for every figure
+    spans = []
+    for fig_enter in re.finditer(r"\\begin\{figure\*?\}", data):
+        fig_close = data[fig_enter.start():fig_enter.end()].replace("\\begin", r"\\end").replace("*", r"\*")
+        text_from_fig_enter = data[fig_enter.end():]
+        match = re.search(fig_close, text_from_fig_enter, flags=re.DOTALL)
+        if not match:
+            continue
+        spans.append((fig_enter.end(), fig_enter.end() + match.start()))
+    return spans
+
+
+# figure contents as found in arXiv papers
+FIGURE_SNIPPETS = [
+    r"""
+\centering
+\includegraphics[width=0.8\linewidth]{figures/overview.pdf}
+\caption{Overview of the method. Given an input $x \in \mathbb{R}^d$, we compute $f(x)$.}
+\label{fig:overview}
+""",
+    r"""
+  \centering
+  \subfloat[Training loss]{\includegraphics[width=0.45\textwidth]{img/loss}}
+  \hfill
+  \subfloat[Validation accuracy]{\includegraphics[width=0.45\textwidth]{img/acc}}
+  \caption{Learning curves on CIFAR-10.}
+  \label{fig:curves}
+""",
+    r"""
+\centering
+\begin{subfigure}[b]{0.48\textwidth}
+    \centering
+    \includegraphics[width=\textwidth]{plots/a.png}
+    \caption{First setting ($\lambda = 0.1$)}
+    \label{fig:a}
+\end{subfigure}
+\hfill
+\begin{subfigure}[b]{0.48\textwidth}
+    \centering
+    \includegraphics[width=\textwidth]{plots/b.png}
+    \caption{Second setting ($\lambda = 1$)}
+    \label{fig:b}
+\end{subfigure}
+\caption[Short]{Comparison of \textbf{both} settings, see Section~\ref{sec:exp}.}
+""",
+    r"""
+\begin{center}
+\resizebox{\linewidth}{!}{\includegraphics{fig1.eps}}
+\end{center}
+\vspace{-2mm}
+\caption{Results (higher is better, 95\% confidence intervals) \cite{smith2020}.}
+""",
+    r"""
+\includegraphics [scale=0.3] {arch}
+\caption {Architecture: $\left( W x + b \right)$ followed by \(\sigma\) and \[ y = \mathrm{softmax}(z) \]}
+""",
+    r"""
+\centering
+\begin{tabular}{cc}
+\includegraphics[width=0.4\linewidth]{a} & \includegraphics[width=0.4\linewidth]{b} \\
+(a) & (b)
+\end{tabular}
+\caption{{\small Two examples.} $$E = mc^2$$}
+""",
+    r"""
+\centering
+\includegraphics[width=\columnwidth]{"figs/my plot".pdf}
+\caption{A figure with a quoted path\footnote{see appendix}.}
+""",
+    r"""
+\centering
+\includegraphics[width=0.5\linewidth]{fig/with_comment}
+% \includegraphics{fig/old}
+\caption{Commented out figure.}
+""",
+    r"""
+\begin{itemize}
+\item \includegraphics{x}
+\end{itemize}
+\caption{An item.}
+""",
+]
+
+FIGURE_FRAGMENTS = [
+    r"\centering", r"\includegraphics[width=0.5\linewidth]{fig/a.pdf}", r"\includegraphics{b}",
+    r"\caption{Caption with $x^2$ and \emph{emphasis}}", r"\caption[s]{long \textbf{bold}}",
+    r"\subfloat[Sub caption]{\includegraphics{c}}", r"\subfloat{\includegraphics{d}}",
+    r"\begin{subfigure}[b]{0.45\textwidth}\centering\includegraphics{e}\caption{sub}\end{subfigure}",
+    r"\label{fig:x}", r"\hfill", r"\\", r"\vspace{-2mm}", r"\begin{center}\includegraphics{f}\end{center}",
+    r"\resizebox{\linewidth}{!}{\includegraphics{g}}", r"\left( x \right)", r"\bigl[", r"\[ a \]",
+    r"$$ b $$", r"\(c\)", r"{\small text}", r"\% 50", r"\mbox{a}\,", r"\includegraphics [scale=0.3] {h}",
+    r"\caption {spaced}", r"\section{x}", r"\section*{y}", r"\noindent", r"~\ref{x}", r"\textbf{b}",
+    r"\begin{tabular}{cc} a & b \\ c & d \end{tabular}", r"]", r"text (with) parens",
+    r"\cap", r"\# \& \_", r"\'e", r"$a_{i}$", r"\subfloat [x] {\includegraphics{i}}", r"\\[2mm]",
+]
+SEPARATORS = ["", " ", "\n", "\n\n", "  \n  ", "\t"]
+
+
+def figure_corpus(nb, seed=0):
+    rng = random.Random(seed)
+    corpus = list(FIGURE_SNIPPETS)
+    while len(corpus) < nb:
+        parts = [rng.choice(SEPARATORS)]
+        for _ in range(rng.randint(1, 8)):
+            parts.append(rng.choice(FIGURE_FRAGMENTS))
+            parts.append(rng.choice(SEPARATORS))
+        corpus.append("".join(parts))
+    return corpus
+
+
+def dump_tree(root):
+    # everything `extract_figure_caption_pairs` looks at
+    out = [str(root)]
+    for n in nodes(root):
+        parents = []
+        p = n.parent
+        while p is not None:
+            parents.append(p.name)
+            p = p.parent
+        out.append((
+            n.name, str(n), node_to_string(n), parents,
+            [(a.name, a.string) for a in n.args], [str(c) for c in n.children],
+        ))
+    return out
+
+
+def extract_math_regex(latex_code):
+    # previous implementation, three regex scans
+    values = re.findall(r"\$(.*?)\$", latex_code)
+    eqs = re.findall(r"\\begin\{equation\}(.*?)\\end\{equation\}", latex_code)
+    values = values + eqs
+    eqs = re.findall(r"\\begin\{math\}(.*?)\\end\{math\}", latex_code)
+    values = values + eqs
+    return values
+
+
+def math(*, size:int=5_000_000, equation_every:int=5, repeat:int=3):
+    """
+    check that the single-pass equation extraction finds the same equations as the previous three
+    regex scans on sources they both handle, and compare them on synthetic .tex files of `size` characters
+    """
+    data = synthetic_tex(size // 10, equation_every=equation_every, equations=SIMPLE_EQUATIONS)
+    old, new = extract_math_regex(data), extract_math(data)
+    print(f"same equations: {sorted(old) == sorted(new)} ({len(new)} equations)")
+    assert sorted(old) == sorted(new)
+    docs = {
+        "inline math only": synthetic_tex(size),
+        "paper-like": synthetic_tex(size, equation_every=equation_every, paragraph=PAPER_PARAGRAPH),
+        "inline math in every line": synthetic_tex(size, equation_every=equation_every),
+    }
+    for name, data in docs.items():
+        t_old, old = timeit(extract_math_regex, data, repeat=repeat)
+        t_new, new = timeit(extract_math, data, repeat=repeat)
+        print(f"{name}, {len(data)/1e6:.1f}M chars")
+        print(f"  three regex scans: {t_old*1000:.1f} ms, {len(old)} equations")
+        print(f"  single pass: {t_new*1000:.1f} ms ({t_old/t_new:.2f}x), {len(new)} equations")
+
+
+def figure_parser(*, nb:int=5000, seed:int=0, repeat:int=3):
+    """
+    check that the lightweight figure parser gives the same trees and figure-caption pairs
+    as TexSoup on a corpus of figure snippets, and compare their speed
+    """
+    corpus = figure_corpus(nb, seed)
+    mismatches = 0
+    fallbacks = 0
+    for fig in corpus:
+        try:
+            expected = dump_tree(TexSoup(fig))
+        except Exception:
+            expected = None
+        try:
+            got = dump_tree(tex_parser.parse(fig))
+        except tex_parser.Unsupported:
+            fallbacks += 1
+            continue
+        if got != expected:
+            mismatches += 1
+            if mismatches <= 5:
+                print("MISMATCH", repr(fig))
+    files = ["figures/overview.pdf", "img/loss.png", "img/acc.png", "plots/a.png", "plots/b.png", "fig1.eps",
+             "arch.pdf", "a.pdf", "b.png", "c.jpg", "e.png", "f.pdf", "g.pdf", "figs/my plot.pdf", "fig/a.pdf"]
+    data = "".join("\\begin{figure}" + fig + "\\end{figure}\n" for fig in corpus)
+    t_soup, soup_pairs = timeit(lambda: list(extract_figure_caption_pairs(data, files, fast=False)), repeat=repeat)
+    t_fast, fast_pairs = timeit(lambda: list(extract_figure_caption_pairs(data, files)), repeat=repeat)
+    if fast_pairs != soup_pairs:
+        mismatches += 1
+        print("MISMATCH in figure-caption pairs")
+    print(f"{len(corpus)} figures, {fallbacks} fell back to TexSoup, {mismatches} mismatches")
+    print(f"TexSoup: {t_soup*1000:.1f} ms")
+    print(f"lightweight parser: {t_fast*1000:.1f} ms ({t_soup/t_fast:.1f}x)")
+    assert mismatches == 0
+
+
+def composite_pil(imgs, caption):
+    # previous compositing, each image resized with PIL and pasted into a new image
+    c = caption.lower()
+    left_or_right = "left" in c or "right" in c
+    top_or_bottom = "top" in c or "bottom" in c
+    if left_or_right:
+        horiz = True
+    elif top_or_bottom:
+        horiz = False
+    else:
+        Wa, Ha = sum(img.width for img in imgs), max(img.height for img in imgs)
+        Wb, Hb = max(img.width for img in imgs), sum(img.height for img in imgs)
+        horiz = abs(Wa/Ha-1) < abs(Wb/Hb-1)
+    if horiz:
+        max_height = max(img.height for img in imgs)
+        new_im = Image.new('RGB', (sum(img.width for img in imgs), max_height), (255,255,255,255))
+        x_offset = 0
+        for img in imgs:
+            img = img.resize((img.width, max_height))
+            new_im.paste(img, (x_offset, 0))
+            x_offset += img.size[0]
+    else:
+        max_width = max(img.width for img in imgs)
+        new_im = Image.new('RGB', (max_width, sum(img.height for img in imgs)), (255,255,255,255))
+        y_offset = 0
+        for img in imgs:
+            img = img.resize((max_width, img.height))
+            new_im.paste(img, (0, y_offset))
+            y_offset += img.size[1]
+    fd = io.BytesIO()
+    new_im.save(fd, format='PNG')
+    return fd.getvalue()
+
+
+def synthetic_figures(nb, seed=0):
+    """
+    `nb` figures made of 2 to 4 encoded images (PNG in various modes, JPEG) of random sizes, with a caption
+    """
+    rng = random.Random(seed)
+    captions = ["(left) training loss, (right) test loss", "top: samples, bottom: reconstructions", "Results on CIFAR-10"]
+    figures = []
+    for _ in range(nb):
+        parts = []
+        for _ in range(rng.randint(2, 4)):
+            w, h = rng.randint(200, 1200), rng.randint(200, 1200)
+            img = Image.linear_gradient("L").resize((w, h)).convert("RGB")
+            img.paste((rng.randrange(256), rng.randrange(256), rng.randrange(256)), (w // 4, h // 4, w // 2, h // 2))
+            fmt, mode = rng.choice([("PNG", "RGB"), ("PNG", "RGBA"), ("PNG", "P"), ("PNG", "L"), ("JPEG", "RGB")])
+            fd = io.BytesIO()
+            img.convert(mode).save(fd, format=fmt)
+            parts.append(fd.getvalue())
+        figures.append((parts, rng.choice(captions)))
+    return figures
+
+
+def composite_full_decode(images, sizes, caption, max_size=None):
+    # `composite` without the reduced-scale decoding of the images it shrinks
+    (width, height), boxes = layout(sizes, is_horizontal(sizes, caption), max_size=max_size)
+    canvas = Image.new("RGB", (width, height), (255, 255, 255))
+    for data, (x, y, w, h) in zip(images, boxes):
+        img = Image.open(io.BytesIO(data))
+        if img.size != (w, h):
+            img = img.resize((w, h))
+        canvas.paste(img, (x, y))
+    return canvas
+
+
+def compositing(*, nb:int=20, seed:int=0, max_size:int=1024):
+    """
+    check that compositing multi-image figures gives the same PNG as before, and compare
+    the speed of the previous PIL compositing, the new one, and the other codecs / downscaling
+    """
+    figures = [(parts, [probe(data)[1:] for data in parts], caption) for parts, caption in synthetic_figures(nb, seed)]
+    def open_all(parts):
+        return [Image.open(io.BytesIO(data)) for data in parts]
+    t_old, old = timeit(lambda: [composite_pil(open_all(parts), caption) for parts, sizes, caption in figures], repeat=1)
+    t_new, new = timeit(lambda: [encode(composite(parts, sizes, caption))[0] for parts, sizes, caption in figures], repeat=1)
+    mismatches = sum(a != b for a, b in zip(old, new))
+    print(f"{nb} figures, {mismatches} mismatches")
+    print(f"PIL resize + paste, PNG: {t_old*1000:.1f} ms")
+    print(f"compositing from the probed sizes, PNG: {t_new*1000:.1f} ms ({t_old/t_new:.1f}x)")
+    t_full, _ = timeit(lambda: [composite_full_decode(parts, sizes, caption, max_size=max_size) for parts, sizes, caption in figures], repeat=3)
+    t_reduced, _ = timeit(lambda: [composite(parts, sizes, caption, max_size=max_size) for parts, sizes, caption in figures], repeat=3)
+    print(f"compositing only, max size {max_size}: full decode {t_full*1000:.1f} ms, reduced decode {t_reduced*1000:.1f} ms ({t_full/t_reduced:.1f}x)")
+    variants = [
+        ("PNG level 1", dict(codec="png", quality=1), None),
+        ("WebP quality 80", dict(codec="webp"), None),
+        ("JPEG quality 90", dict(codec="jpeg", quality=90), None),
+        (f"PNG, max size {max_size}", dict(codec="png"), max_size),
+        (f"JPEG quality 90, max size {max_size}", dict(codec="jpeg", quality=90), max_size),
+    ]
+    for name, options, size in variants:
+        t, out = timeit(lambda: [encode(composite(parts, sizes, caption, max_size=size), **options)[0] for parts, sizes, caption in figures], repeat=1)
+        print(f"{name}: {t*1000:.1f} ms ({t_old/t:.1f}x), {sum(map(len, out))/1e6:.1f} MB (PNG: {sum(map(len, new))/1e6:.1f} MB)")
+    assert mismatches == 0
+
+
+def image_probe(*, nb:int=20, seed:int=0, repeat:int=20):
+    """
+    check that the header-only probe finds the same format and size as `Image.open`, and compare their speed
+    """
+    images = [data for parts, caption in synthetic_figures(nb, seed) for data in parts]
+    def open_all():
+        return [(img.format,) + img.size for img in (Image.open(io.BytesIO(data)) for data in images)]
+    t_pil, expected = timeit(open_all, repeat=repeat)
+    t_probe, got = timeit(lambda: [probe(data) for data in images], repeat=repeat)
+    mismatches = sum(a != b for a, b in zip(expected, got))
+    print(f"{len(images)} images, {mismatches} mismatches")
+    print(f"Image.open: {t_pil*1e6/len(images):.1f} us per image")
+    print(f"probe: {t_probe*1e6/len(images):.1f} us per image ({t_pil/t_probe:.1f}x)")
+    assert mismatches == 0
+
+
+def tex_fallback():
+    """
+    check that a batch of equations with one making pdflatex fail is rendered with the pdflatex fallback,
+    the failing equation alone being dropped (skipped if pdflatex or pdftoppm is missing)
+    """
+    if not has_tex_fallback():
+        print("pdflatex or pdftoppm is missing or can't render equations, skipped")
+        return
+    equations = [r"x^2 + y^2", r"\begin{pmatrix} a & b \\ c & d \end{pmatrix}", r"\undefinedmacro{x}", r"\mathbb{R}^n"]
+    mathtext_only = render_chunk(equations)
+    t, images = timeit(lambda: render_chunk(equations, fallback="pdflatex"), repeat=1)
+    print(f"mathtext: {sum(img is not None for img in mathtext_only)}/{len(equations)} rendered")
+    print(f"with the pdflatex fallback: {sum(img is not None for img in images)}/{len(equations)} rendered in {t*1000:.1f} ms")
+    assert images[2] is None
+    assert all(img is not None for i, img in enumerate(images) if i != 2)
+    assert all(a == b for a, b in zip(mathtext_only, images) if a is not None)
+
+
+def crashing_parser(item):
+    # exits on items multiple of 5, killed by a signal on items multiple of 7
+    if item % 5 == 0:
+        os._exit(3)
+    if item % 7 == 0:
+        os.kill(os.getpid(), signal.SIGKILL)
+    for i in range(item % 4):
+        yield {"item": item, "i": i}
+
+
+def worker_deaths(*, nb:int=40, num_workers:int=3):
+    """
+    check that `stream_map` replaces the workers that die, reports the items they were processing
+    and processes all the other items
+    """
+    t, out = timeit(lambda: list(stream_map(crashing_parser, range(1, nb + 1), num_workers)), repeat=1)
+    crashing = {item for item in range(1, nb + 1) if item % 5 == 0 or item % 7 == 0}
+    done = {d["__done__"] for d in out if "__done__" in d}
+    failed = {d["__failed__"] for d in out if "__failed__" in d}
+    samples = [d for d in out if "item" in d]
+    print(f"{nb} items in {t:.1f}s, {len(done)} done, {len(failed)} failed, {len(samples)} samples")
+    assert failed == crashing, failed ^ crashing
+    assert done == set(range(1, nb + 1)) - crashing
+    assert len(samples) == sum(item % 4 for item in done)
+
+
+def timeit(fn, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+def figures(*, size:int=5_000_000, figure_every:int=20):
+    """
+    benchmark figure environment detection on a synthetic .tex file of `size` characters
+    """
+    data = synthetic_tex(size, figure_every)
+    t_old, old = timeit(find_figures_slicing, data)
+    t_new, new = timeit(find_figures, data)
+    assert old == new
+    print(f"{len(data)/1e6:.1f}M chars, {len(new)} figures")
+    print(f"slicing: {t_old*1000:.1f} ms")
+    print(f"single pass: {t_new*1000:.1f} ms ({t_old/t_new:.1f}x)")
+
+
+if __name__ == "__main__":
+    run([figures, figure_parser, math, compositing, image_probe, tex_fallback, worker_deaths])
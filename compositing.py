@@ -0,0 +1,89 @@
+import io
+from PIL import Image
+
+# output codecs, name -> (PIL format, file extension, quality option, default quality)
+CODECS = {
+    "png": ("PNG", ".png", "compress_level", 6),
+    "webp": ("WEBP", ".webp", "quality", 80),
+    "jpeg": ("JPEG", ".jpg", "quality", 75),
+}
+
+
+def is_horizontal(sizes, caption):
+    """
+    heuristic to find if the subfigures of sizes `sizes` are concatenated horizontally or vertically,
+    from the caption if it talks about left/right or top/bottom, otherwise the layout
+    which is the closest to a square is chosen
+    """
+    c = caption.lower()
+    left_or_right = "left" in c or "right" in c
+    top_or_bottom = "top" in c or "bottom" in c
+    if left_or_right:
+        return True
+    if top_or_bottom:
+        return False
+    Wa = sum(w for w, h in sizes)
+    Ha = max(h for w, h in sizes)
+    Wb = max(w for w, h in sizes)
+    Hb = sum(h for w, h in sizes)
+    return abs(Wa / Ha - 1) < abs(Wb / Hb - 1)
+
+
+def layout(sizes, horiz, max_size=None):
+    """
+    return the size of the canvas and the box (x, y, width, height) of each image.
+    Images are stretched to the tallest height (horizontally) or the largest width (vertically),
+    then everything is scaled down so that the largest side of the canvas is at most `max_size`.
+    """
+    if horiz:
+        height = max(h for w, h in sizes)
+        sizes = [(w, height) for w, h in sizes]
+        width = sum(w for w, h in sizes)
+    else:
+        width = max(w for w, h in sizes)
+        sizes = [(width, h) for w, h in sizes]
+        height = sum(h for w, h in sizes)
+    if max_size and max(width, height) > max_size:
+        scale = max_size / max(width, height)
+        sizes = [(max(round(w * scale), 1), max(round(h * scale), 1)) for w, h in sizes]
+    boxes = []
+    offset = 0
+    for w, h in sizes:
+        boxes.append((offset, 0, w, h) if horiz else (0, offset, w, h))
+        offset += w if horiz else h
+    if horiz:
+        return (offset, max(h for w, h in sizes)), boxes
+    return (max(w for w, h in sizes), offset), boxes
+
+
+def composite(images, sizes, caption, max_size=None):
+    """
+    concatenate the encoded images `images` into a single RGB image.
+    The layout is computed from `sizes`, the sizes read from the headers (see `image_probe.probe`),
+    then each image is decoded, at a reduced scale if the canvas shrinks it (JPEG `draft`, `Image.reduce`),
+    resized to its box and pasted.
+    """
+    (width, height), boxes = layout(sizes, is_horizontal(sizes, caption), max_size=max_size)
+    canvas = Image.new("RGB", (width, height), (255, 255, 255))
+    for data, (x, y, w, h) in zip(images, boxes):
+        img = Image.open(io.BytesIO(data))
+        shrunk = w < img.width and h < img.height
+        if shrunk and img.format == "JPEG":
+            img.draft("RGB", (w, h))
+        if img.size != (w, h):
+            # images that are not shrunk are resized as before, so that the output does not change
+            img = img.resize((w, h), reducing_gap=2.0 if shrunk else None)
+        canvas.paste(img, (x, y))
+    return canvas
+
+
+def encode(img, codec="png", quality=None):
+    """
+    encode a PIL image with one of `CODECS`, `quality` being the compression level for PNG (0-9)
+    and the quality for WebP and JPEG (0-100).
+    Returns (data, extension).
+    """
+    fmt, ext, option, default = CODECS[codec]
+    fd = io.BytesIO()
+    img.save(fd, format=fmt, **{option: default if quality is None else quality})
+    return fd.getvalue(), ext
@@ -0,0 +1,193 @@
+import os
+import re
+import sqlite3
+import hashlib
+from collections import Counter
+
+from render_cache import normalize_latex, journal_mode
+from guard import critical
+
+TOKEN = re.compile(r"\\[A-Za-z]+|\\.|\S")
+RULES = ("too_short", "too_long", "too_simple", "too_complex", "unbalanced", "duplicate_in_paper", "duplicate")
+
+
+def braces_balanced(math):
+    """
+    check that (unescaped) braces are balanced
+    """
+    depth = 0
+    escaped = False
+    for c in math:
+        if escaped:
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth < 0:
+                return False
+    return depth == 0
+
+
+def nb_tokens(math):
+    """
+    complexity of an equation: its number of tokens, a control sequence being a single token
+    """
+    return len(TOKEN.findall(math))
+
+
+def dedup_key(norm):
+    return hashlib.md5(norm.encode()).digest()
+
+
+class EquationFilter:
+    """
+    drops equations before they are rendered:
+
+    - shorter than `min_length` or longer than `max_length` characters (after whitespace normalization)
+    - with less than `min_tokens` or more than `max_tokens` tokens (e.g. single symbols like `x` or `\\alpha`)
+    - with unbalanced braces
+    - repeated within a paper
+    - already extracted from another paper, if `dedup` is the path of a SQLite file, shared by
+      all the workers (and runs) using it. An equation belongs to the first paper it is written from
+      (see `claim`, called by the process writing the samples), so equations of papers that are
+      quarantined or fail to render are not lost, and processing a paper again (e.g. on resume)
+      gives the same equations.
+
+    `counts` holds the number of equations dropped by each rule.
+    """
+
+    def __init__(self, min_length=1, max_length=1000, min_tokens=2, max_tokens=500, dedup=None):
+        self.min_length = min_length
+        self.max_length = max_length
+        self.min_tokens = min_tokens
+        self.max_tokens = max_tokens
+        self.dedup = dedup
+        self.db = None
+        self.pid = None
+        self.counts = Counter()
+
+    def connect(self):
+        if self.dedup is None:
+            return None
+        if self.db is None or self.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.dedup) or ".", exist_ok=True)
+            with critical():
+                self.db = sqlite3.connect(self.dedup, timeout=60)
+                self.db.execute(f"PRAGMA journal_mode={journal_mode(self.dedup)}")
+                self.db.execute("PRAGMA synchronous=NORMAL")
+                self.db.execute("CREATE TABLE IF NOT EXISTS seen (key BLOB PRIMARY KEY, url TEXT)")
+                self.db.commit()
+                self.pid = os.getpid()
+        return self.db
+
+    def rule(self, math):
+        """
+        return the name of the first rule dropping `math`, None if it is kept
+        """
+        if len(math) < self.min_length:
+            return "too_short"
+        if len(math) > self.max_length:
+            return "too_long"
+        n = nb_tokens(math)
+        if n < self.min_tokens:
+            return "too_simple"
+        if n > self.max_tokens:
+            return "too_complex"
+        if not braces_balanced(math):
+            return "unbalanced"
+        return None
+
+    def filter(self, equations, url):
+        """
+        return the equations of the paper `url` that are kept, in order
+        """
+        kept = {}
+        for math in equations:
+            norm = normalize_latex(math)
+            rule = self.rule(norm)
+            if rule is None and norm in kept:
+                rule = "duplicate_in_paper"
+            if rule is not None:
+                self.counts[rule] += 1
+                continue
+            kept[norm] = math
+        db = self.connect()
+        if db is None or not kept:
+            return list(kept.values())
+        # equations claimed by other papers are not rendered, the others are claimed once written
+        keys = {dedup_key(norm): norm for norm in kept}
+        owners = {}
+        try:
+            key_list = list(keys)
+            for i in range(0, len(key_list), 500):
+                chunk = key_list[i:i + 500]
+                query = "SELECT key, url FROM seen WHERE key IN (%s)" % ",".join("?" * len(chunk))
+                owners.update(db.execute(query, chunk).fetchall())
+        except sqlite3.Error as ex:
+            print(ex)
+            return list(kept.values())
+        result = []
+        for key, norm in keys.items():
+            if owners.get(key, url) != url:
+                self.counts["duplicate"] += 1
+            else:
+                result.append(kept[norm])
+        return result
+
+    def claim(self, maths, url):
+        """
+        to be called before the equations `maths` of the paper `url` are written, in a single transaction:
+        return for each one False if it was already written from another paper, True otherwise
+        """
+        db = self.connect()
+        if db is None or not maths:
+            return [True] * len(maths)
+        keys = [dedup_key(normalize_latex(math)) for math in maths]
+        owners = {}
+        try:
+            with db:
+                db.executemany("INSERT OR IGNORE INTO seen (key, url) VALUES (?, ?)", [(key, url) for key in keys])
+                unique = list(set(keys))
+                for i in range(0, len(unique), 500):
+                    chunk = unique[i:i + 500]
+                    query = "SELECT key, url FROM seen WHERE key IN (%s)" % ",".join("?" * len(chunk))
+                    owners.update(db.execute(query, chunk).fetchall())
+        except sqlite3.Error as ex:
+            print(ex)
+            return [True] * len(maths)
+        return [owners.get(key, url) == url for key in keys]
+
+    def pop_counts(self):
+        counts = self.counts
+        self.counts = Counter()
+        return counts
+
+
+_filters = {}
+
+
+def get_equation_filter(**options):
+    """
+    equation filter of the current process for the given options
+    """
+    key = tuple(sorted(options.items()))
+    if key not in _filters:
+        _filters[key] = EquationFilter(**options)
+    return _filters[key]
+
+
+def print_filter_report(counts, nb_equations):
+    """
+    `counts` maps the rules of `EquationFilter` to numbers of dropped equations,
+    out of `nb_equations` equations found
+    """
+    if not nb_equations:
+        return
+    dropped = sum(counts.values())
+    print(f"Equation filter: {dropped}/{nb_equations} equations dropped ({100*dropped/nb_equations:.1f}%)")
+    for rule in RULES:
+        if counts.get(rule):
+            print(f"  {rule}: {counts[rule]}")
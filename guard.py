@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import signal
+import resource
+import threading
+from contextlib import contextmanager
+from metrics import count
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+# depth of the `critical` blocks of the main thread, and the budget whose timer fired in one of them
+_critical = 0
+_pending = None
+
+
+class BudgetExceeded(BaseException):
+    """
+    raised inside the processing of an input that went over its budget.
+    It is not an `Exception` so that the `except Exception` of the parsers can't swallow it.
+    """
+
+
+def current_rss():
+    """
+    resident memory of the current process in bytes
+    """
+    try:
+        with open("/proc/self/statm") as fd:
+            return int(fd.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        # peak instead of current memory, in kB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextmanager
+def critical():
+    """
+    block that the SIGALRM timer of a `Budget` must not interrupt (e.g. a SQLite write or a matplotlib render):
+    a budget exceeded meanwhile raises `BudgetExceeded` at the end of the block instead
+    """
+    global _critical, _pending
+    if threading.current_thread() is not threading.main_thread():
+        # the timer only interrupts the main thread
+        yield
+        return
+    _critical += 1
+    try:
+        yield
+    finally:
+        _critical -= 1
+        if _critical == 0 and _pending is not None:
+            budget, _pending = _pending, None
+            budget.check()
+
+
+class Budget:
+    """
+    wall-clock (`timeout` seconds) and memory (`max_memory` bytes of RSS growth) budget of an input.
+    Time is only counted while inside the `with` block, so a generator can be charged only for
+    the time it spends producing samples, not for the time its consumer spends on them.
+    Memory is measured from the RSS of the process when the block is first entered, as the process
+    also holds what previous inputs left (caches, pools, samples waiting to be written).
+
+    In the main thread, a SIGALRM timer checks the budget every `interval` seconds and interrupts
+    the processing (even in a pure-Python loop) by raising `BudgetExceeded`, except inside `critical`
+    blocks, where it is raised at the end of the block. In other threads, the budget is only checked
+    when entering the block.
+    """
+
+    def __init__(self, timeout=None, max_memory=None, interval=1.0):
+        self.timeout = timeout
+        self.max_memory = max_memory
+        self.interval = interval
+        self.elapsed = 0.0
+        self.started = None
+        self.start_rss = None
+        self.previous_handler = None
+
+    def check(self):
+        elapsed = self.elapsed
+        if self.started is not None:
+            elapsed += time.monotonic() - self.started
+        if self.timeout and elapsed > self.timeout:
+            raise BudgetExceeded(f"timeout ({elapsed:.0f}s)")
+        if self.max_memory:
+            growth = current_rss() - self.start_rss
+            if growth > self.max_memory:
+                raise BudgetExceeded(f"memory (+{growth/1e9:.1f} GB)")
+
+    def on_alarm(self, signum, frame):
+        global _pending
+        if _critical:
+            _pending = self
+        else:
+            self.check()
+
+    def __enter__(self):
+        if self.max_memory and self.start_rss is None:
+            self.start_rss = current_rss()
+        self.check()
+        self.started = time.monotonic()
+        if (self.timeout or self.max_memory) and threading.current_thread() is threading.main_thread():
+            self.previous_handler = signal.signal(signal.SIGALRM, self.on_alarm)
+            first = self.interval
+            if self.timeout:
+                first = min(first, max(self.timeout - self.elapsed, 0.001))
+            signal.setitimer(signal.ITIMER_REAL, first, self.interval)
+        return self
+
+    def __exit__(self, *exc):
+        global _pending
+        if self.previous_handler is not None:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, self.previous_handler)
+            self.previous_handler = None
+        if _pending is self:
+            # checked again when entering the block
+            _pending = None
+        self.elapsed += time.monotonic() - self.started
+        self.started = None
+        return False
+
+
+class Quarantine:
+    """
+    append-only JSONL list of the inputs that were skipped, with the reason.
+    Each record is a single `write` on a file opened in append mode, so several processes can share it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def add(self, name, reason, **info):
+        line = json.dumps({"input": name, "reason": reason, **info}) + "\n"
+        with open(self.path, "a") as fd:
+            fd.write(line)
+
+
+def guarded(samples, name, timeout=None, max_memory=None, quarantine=None, **info):
+    """
+    yield from the generator `samples` (produced from the input `name`) within a `Budget`.
+    If the budget is exceeded or the generator raises an exception, it is stopped (the samples already
+    yielded are kept), the input is logged to the `quarantine` file if given, and the iteration ends normally.
+    """
+    budget = Budget(timeout=timeout, max_memory=max_memory)
+    while True:
+        try:
+            with budget:
+                sample = next(samples)
+        except StopIteration:
+            return
+        except (BudgetExceeded, Exception) as ex:
+            reason = str(ex) if isinstance(ex, BudgetExceeded) else f"{type(ex).__name__}: {ex}"
+            print(f"Skipping {name}: {reason}")
+            count("papers_quarantined")
+            samples.close()
+            if quarantine:
+                Quarantine(quarantine).add(name, reason, elapsed=round(budget.elapsed, 1), **info)
+            return
+        yield sample
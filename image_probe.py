@@ -0,0 +1,136 @@
+import io
+import re
+import struct
+from PIL import Image
+
+PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+# JPEG start of frame markers (0xC4, 0xC8 and 0xCC are not frames)
+JPEG_SOF = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+BOUNDING_BOX = re.compile(rb"%%BoundingBox:[ \t]*([-+\d.]+)[ \t]+([-+\d.]+)[ \t]+([-+\d.]+)[ \t]+([-+\d.]+)")
+
+
+def probe_png(data):
+    if len(data) < 24 or data[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", data[16:24])
+
+
+def probe_gif(data):
+    if len(data) < 10:
+        return None
+    return struct.unpack("<HH", data[6:10])
+
+
+def probe_jpeg(data):
+    i = 2
+    n = len(data)
+    while i + 4 <= n:
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            # markers without payload
+            i += 2
+            continue
+        length, = struct.unpack(">H", data[i + 2:i + 4])
+        if marker in JPEG_SOF:
+            if i + 9 > n:
+                return None
+            height, width = struct.unpack(">HH", data[i + 5:i + 9])
+            return width, height
+        i += 2 + length
+    return None
+
+
+def probe_tiff(data):
+    endian = "<" if data[:2] == b"II" else ">"
+    if len(data) < 8:
+        return None
+    offset, = struct.unpack(endian + "I", data[4:8])
+    if offset + 2 > len(data):
+        return None
+    nb, = struct.unpack(endian + "H", data[offset:offset + 2])
+    size = {}
+    for i in range(nb):
+        entry = data[offset + 2 + 12 * i:offset + 14 + 12 * i]
+        if len(entry) < 12:
+            return None
+        tag, kind = struct.unpack(endian + "HH", entry[:4])
+        if tag in (256, 257):
+            # SHORT or LONG
+            if kind == 3:
+                size[tag], = struct.unpack(endian + "H", entry[8:10])
+            else:
+                size[tag], = struct.unpack(endian + "I", entry[8:12])
+    if 256 not in size or 257 not in size:
+        return None
+    return size[256], size[257]
+
+
+def postscript_section(data):
+    """
+    PostScript part of an EPS file, without the DOS EPS binary header if any
+    (which gives the offset and length of the PostScript section)
+    """
+    if data[:4] == b"\xc5\xd0\xd3\xc6":
+        offset, length = struct.unpack("<II", data[4:12])
+        return data[offset:offset + length]
+    return data
+
+
+def bounding_box(data):
+    """
+    (x0, y0, x1, y1) of a PostScript file in points, None if it has none.
+    It is in the header, or in the trailer with `%%BoundingBox: (atend)`
+    """
+    m = BOUNDING_BOX.search(data, 0, 65536) or BOUNDING_BOX.search(data, max(len(data) - 65536, 0))
+    if m is None:
+        return None
+    return tuple(float(v) for v in m.groups())
+
+
+def probe_eps(data):
+    box = bounding_box(postscript_section(data))
+    if box is None:
+        return None
+    x0, y0, x1, y1 = box
+    return int(x1 - x0), int(y1 - y0)
+
+
+PROBES = [
+    (PNG_MAGIC, "PNG", probe_png),
+    (b"\xff\xd8", "JPEG", probe_jpeg),
+    (b"GIF87a", "GIF", probe_gif),
+    (b"GIF89a", "GIF", probe_gif),
+    (b"II*\x00", "TIFF", probe_tiff),
+    (b"MM\x00*", "TIFF", probe_tiff),
+    (b"%!PS", "EPS", probe_eps),
+    (b"\xc5\xd0\xd3\xc6", "EPS", probe_eps),
+]
+
+
+def probe(data):
+    """
+    return (format, width, height) of an encoded image read from its header only, without decoding it,
+    None if it is not an image.
+    PNG, JPEG, GIF, TIFF and EPS are recognized from their magic bytes, other formats
+    go through `Image.open` (which only reads the header too, but is slower).
+    """
+    for magic, fmt, fn in PROBES:
+        if data.startswith(magic):
+            try:
+                size = fn(data)
+            except struct.error:
+                return None
+            if size is None or size[0] <= 0 or size[1] <= 0:
+                return None
+            return (fmt,) + tuple(size)
+    try:
+        img = Image.open(io.BytesIO(data))
+    except Exception:
+        return None
+    return (img.format,) + img.size
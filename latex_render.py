@@ -1,33 +1,38 @@
-from joblib import Parallel, delayed
 import random
+import re
 import time
 import os
 from PIL import Image
-from subprocess import call
+import subprocess
+import shutil
 import tempfile
-import uuid
 import gc
 import io
+import math
+import multiprocessing
+import multiprocessing.util
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from pdf2image import convert_from_path
 
-tpl = r"""
-\documentclass[crop]{standalone}
-\begin{document}
-${MATH}$
-\end{document}
-"""
+from rasterize import scratch_dir
+from guard import critical
 
 from matplotlib import mathtext, font_manager
 import matplotlib as mpl
 mpl.rcParams['savefig.transparent'] = True
 #texFont = font_manager.FontProperties(size=30, fname="./OpenSans-Medium.ttf")
-texFont = font_manager.FontProperties(size=30, family='serif', math_fontfamily='cm')
+# everything that changes the rendered image, part of the render cache key
+# ("fallback" is "pdflatex" when the equations mathtext can't render are rendered with pdflatex, see `has_tex_fallback`)
+RENDER_SETTINGS = {"size": 30, "family": "serif", "math_fontfamily": "cm", "dpi": 100, "format": "png", "fallback": None}
+texFont = font_manager.FontProperties(size=RENDER_SETTINGS["size"], family=RENDER_SETTINGS["family"], math_fontfamily=RENDER_SETTINGS["math_fontfamily"])
 
 def latex2imagev2(math):
     #gc.collect()
     #return Image.new(size=(1, 1), mode='RGB')
     fd = io.BytesIO()
     try:
-        mathtext.math_to_image('$' + math + '$', fd, prop=texFont, dpi=100, format='png')
+        mathtext.math_to_image('$' + math + '$', fd, prop=texFont, dpi=RENDER_SETTINGS["dpi"], format=RENDER_SETTINGS["format"])
     except Exception:
         fd.close()
         return None
@@ -39,45 +44,221 @@ def latex2imagev2(math):
     del fd
     return data
 
+class MathRenderer:
+    """
+    renders equations exactly like `latex2imagev2`, but keeps the mathtext parser (and its caches),
+    the figure, the text artist and the output buffer alive between equations.
+    Renders are not interrupted by the budget of the paper (see `guard.critical`), which would leave the figure half-drawn.
+    """
+
+    def __init__(self):
+        from matplotlib.figure import Figure
+        self.parser = mathtext.MathTextParser('path')
+        self.fig = Figure()
+        self.text = self.fig.text(0, 0, "", fontproperties=texFont)
+        self.fd = io.BytesIO()
+
+    def render(self, math):
+        s = '$' + math + '$'
+        with critical():
+            try:
+                width, height, depth, _, _ = self.parser.parse(s, dpi=72, prop=texFont)
+                self.fig.set_size_inches(width / 72.0, height / 72.0)
+                self.text.set_text(s)
+                self.text.set_y(depth / height)
+                self.fd.seek(0)
+                self.fd.truncate()
+                self.fig.savefig(self.fd, dpi=RENDER_SETTINGS["dpi"], format=RENDER_SETTINGS["format"])
+            except Exception:
+                return None
+            return self.fd.getvalue()
+
+
+_renderer = None
+_render_pool = None
+
+
+def get_renderer():
+    global _renderer
+    if _renderer is None:
+        _renderer = MathRenderer()
+    return _renderer
+
+
+def render_chunk(equations, fallback=None):
+    """
+    render equations with mathtext, those mathtext can't render are rendered with pdflatex if `fallback` is "pdflatex"
+    """
+    renderer = get_renderer()
+    images = [renderer.render(math) for math in equations]
+    failed = [i for i, img in enumerate(images) if img is None]
+    if failed and fallback == "pdflatex":
+        for i, img in zip(failed, get_tex_renderer().render_batch([equations[i] for i in failed])):
+            images[i] = img
+    return images
+
+
+def get_render_pool(num_workers):
+    """
+    process pool of the current process rendering equations, None if it can't have one
+    (e.g. in a DataLoader worker, which is a daemonic process)
+    """
+    global _render_pool
+    if _render_pool is None:
+        if multiprocessing.current_process().daemon:
+            return None
+        _render_pool = ProcessPoolExecutor(max_workers=num_workers)
+    return _render_pool
+
+
+def render_batch(equations, num_workers=0, chunk_size=64, fallback=None):
+    """
+    render a batch of equations, returns a list with the PNG bytes of each equation (None if it can't be rendered).
+    with `num_workers` > 0 the batch is split into chunks rendered by a pool of processes,
+    otherwise (or if the current process can't start a pool) it is rendered in the current process.
+    `fallback` is passed to `render_chunk`.
+    """
+    equations = list(equations)
+    pool = get_render_pool(num_workers) if num_workers else None
+    if pool is None:
+        return render_chunk(equations, fallback=fallback)
+    chunk_size = max(min(chunk_size, math.ceil(len(equations) / num_workers)), 1)
+    chunks = [equations[i:i + chunk_size] for i in range(0, len(equations), chunk_size)]
+    return [img for imgs in pool.map(partial(render_chunk, fallback=fallback), chunks) for img in imgs]
+
+
+# one page per equation, cropped
+TEX_BATCH = r"""\documentclass[multi=eqpage,border=1pt]{standalone}
+\usepackage{amsmath}
+\usepackage{amssymb}
+\newenvironment{eqpage}{$\displaystyle}{$}
+\begin{document}
+%s
+\end{document}
+"""
+TEX_ERROR_LINE = re.compile(r"^l\.(\d+) ", re.M)
+# pdflatex uses 10pt fonts, scaled to the mathtext font size
+TEX_DPI = RENDER_SETTINGS["dpi"] * RENDER_SETTINGS["size"] // 10
+
+
+class TexRenderer:
+    """
+    renders equations with pdflatex, for the macros mathtext does not support.
+    A batch of equations is compiled as a single multi-page standalone document (one page per equation),
+    whose pages are then converted to PNG with a single pdftoppm call.
+    Each process compiles in its own scratch folder, without shell escape, with reading and writing
+    restricted to that folder, and with a timeout per document.
+    Equations that make pdflatex fail are found from the log and the batch is compiled again without them,
+    so that a single equation can't make the batch fail.
+    """
+
+    def __init__(self, timeout=60, dpi=TEX_DPI):
+        self.timeout = timeout
+        self.dpi = dpi
+        self.folder = tempfile.mkdtemp(prefix="tex-", dir=scratch_dir())
+        self.env = dict(os.environ, openin_any="p", openout_any="p", shell_escape="f")
+
+    def compile(self, equations):
+        """
+        compile `equations` (one per line of the document), returns (paths of the PNG pages, lines of the errors),
+        (None, ()) if pdflatex or pdftoppm failed
+        """
+        for name in os.listdir(self.folder):
+            os.remove(os.path.join(self.folder, name))
+        # the equations start at line 6 of the document
+        body = "\n".join(r"\begin{eqpage}%s\end{eqpage}" % math.replace("\n", " ") for math in equations)
+        with open(os.path.join(self.folder, "batch.tex"), "w") as fd:
+            fd.write(TEX_BATCH % body)
+        try:
+            subprocess.run(
+                ["pdflatex", "-interaction=nonstopmode", "-no-shell-escape", "batch.tex"],
+                cwd=self.folder, env=self.env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                timeout=self.timeout,
+            )
+        except (OSError, subprocess.TimeoutExpired) as ex:
+            print(ex)
+            return None, ()
+        errors = ()
+        if os.path.exists(os.path.join(self.folder, "batch.log")):
+            with open(os.path.join(self.folder, "batch.log"), errors="replace") as fd:
+                errors = {int(line) - 6 for line in TEX_ERROR_LINE.findall(fd.read())}
+        if not os.path.exists(os.path.join(self.folder, "batch.pdf")):
+            return None, errors
+        try:
+            paths = convert_from_path(
+                os.path.join(self.folder, "batch.pdf"), dpi=self.dpi, fmt="png", transparent=True,
+                output_folder=self.folder, output_file="page", paths_only=True, timeout=self.timeout,
+            )
+        except Exception as ex:
+            print(ex)
+            return None, errors
+        return paths, errors
+
+    def render_batch(self, equations):
+        """
+        render a list of equations, returns the PNG bytes of each equation (None if it can't be rendered)
+        """
+        results = [None] * len(equations)
+        todo = list(range(len(equations)))
+        while todo:
+            paths, errors = self.compile([equations[i] for i in todo])
+            errors = {todo[line] for line in errors if 0 <= line < len(todo)}
+            if not errors and paths is not None and len(paths) == len(todo):
+                for i, path in zip(todo, paths):
+                    with open(path, "rb") as fd:
+                        results[i] = fd.read()
+                break
+            if not errors:
+                # the pages can't be matched with the equations, compile them one by one
+                if len(todo) > 1:
+                    for i in todo:
+                        results[i] = self.render_batch([equations[i]])[0]
+                break
+            todo = [i for i in todo if i not in errors]
+        return results
+
+    def close(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+_tex_renderers = {}
+
+
+def get_tex_renderer():
+    """
+    pdflatex renderer of the current process (a forked worker gets its own scratch folder),
+    removed when the process exits
+    """
+    pid = os.getpid()
+    if pid not in _tex_renderers:
+        renderer = _tex_renderers[pid] = TexRenderer()
+        # unlike `atexit`, also run when a worker process exits
+        multiprocessing.util.Finalize(renderer, renderer.close, exitpriority=10)
+    return _tex_renderers[pid]
+
+
+def has_tex_fallback():
+    """
+    whether pdflatex and pdftoppm are installed and render a test equation
+    """
+    if shutil.which("pdflatex") is None or shutil.which("pdftoppm") is None:
+        return False
+    return get_tex_renderer().render_batch([r"\alpha"])[0] is not None
+
+
 def latex2image(math):
-    name = "tmp" + str(uuid.uuid4())
-    tex_path = name + ".tex"
-    png_path = name + ".png"
-    ps_path = (name) + ".ps"
-    dvi_path = (name) + ".dvi"
-    pdf_path = (name) + ".pdf"
-    aux_path = (name) + ".aux"
-    log_path = (name) + ".log"
-    data = tpl.replace("{MATH}", math)
-    with open(tex_path, "w") as fd:
-        fd.write(data)
-    call(f"pdflatex -interaction=nonstopmode --job-name={name} {tex_path} 2>/dev/null 1>/dev/null;convert -density 256  {pdf_path} {png_path} 2>/dev/null 1>/dev/null", shell=True)
-    #call(f"pdflatex -interaction=nonstopmode --job-name={name} {tex_path} 2>/dev/null 1>/dev/null;pdf2ps {pdf_path} {ps_path} 2>/dev/null 1>/dev/null", shell=True)
-    #call(f"latex -interaction=nonstopmode --job-name={name} {tex_path} 2>/dev/null 1>/dev/null;dvips -o {ps_path} {dvi_path}", shell=True)
-    #call(f"latex -interaction=nonstopmode --job-name={name} {tex_path} 2>/dev/null 1>/dev/null", shell=True)
-    img = None
-    if os.path.exists(ps_path):
-        img = Image.open(ps_path)
-        os.remove(ps_path)
-    if os.path.exists(png_path):
-        img = Image.open(png_path)
-        os.remove(png_path)
-    if os.path.exists(tex_path):
-        os.remove(tex_path)
-    if os.path.exists(pdf_path):
-        os.remove(pdf_path)
-    if os.path.exists(aux_path):
-        os.remove(aux_path)
-    if os.path.exists(log_path):
-        os.remove(log_path)
-    if os.path.exists(dvi_path):
-        os.remove(dvi_path)
-    return img
+    """
+    render an equation with pdflatex, returns a PIL image (None if it can't be rendered)
+    """
+    data = get_tex_renderer().render_batch([math])[0]
+    if data is None:
+        return None
+    return Image.open(io.BytesIO(data))
 
 if __name__ == "__main__":
     N = 1000
     t0 = time.time()
-    Parallel(n_jobs=16, backend="threading")(( delayed(latex2imagev2)("C=1 + 10 + 10 + 20 + {i}") for i in range(N)))
+    render_batch([f"C=1 + 10 + 10 + 20 + {i}" for i in range(N)], num_workers=16)
     dt = time.time() - t0
     print(dt, N/dt)
 
@@ -1,5 +1,6 @@
 import random
 import tarfile
+from collections import defaultdict, Counter
 import math
 import torch
 import time
@@ -12,13 +13,20 @@ import zipfile
 import pubmed_parser as pp
 import fsspec
 
-from writer import TarWriter
+from writer import ShardWriterPool
 import io
-from joblib import Parallel, delayed
 
-from meca import MecaIterableDataset, parse_meca_to_list
-from arxiv import ArxivFigureCaptions, ArxivEquations, parse_arxiv_shard_tar_to_list
-from pubmed import PubMedIterableDataset, parse_pubmed_to_list
+from meca import MecaIterableDataset, parse_meca
+from arxiv import ArxivFigureCaptions, ArxivEquations, parse_arxiv_shard_tar
+from pubmed import PubMedIterableDataset, parse_pubmed
+from scheduler import WorkQueue, QueuedDataset, stream_map, get_rank, partition
+from manifest import Manifest, merge_manifests
+from render_cache import print_cache_report
+from latex_render import has_tex_fallback
+from equation_filter import print_filter_report, get_equation_filter
+from compositing import CODECS
+from metrics import Metrics, MetricsLog, get_metrics
+from profiling import Profiled, PROFILERS, reset_output, merge_profiles
 
 def worker_init_fn(worker_id):
     worker_info = torch.utils.data.get_worker_info()
@@ -32,6 +40,12 @@ def worker_init_fn(worker_id):
     dataset.end = min(dataset.start + per_worker, overall_end)
 
 
+# processors producing several kinds of samples (`__kind__`), each one written to its own shards
+OUTPUTS = {
+    "arxiv": ["figure_captions", "math"],
+}
+
+
 def get_ds(filelist, processor):
     if processor in ("biorxiv", "medarxiv"):
         ds = MecaIterableDataset(filelist)  
@@ -41,86 +55,313 @@ def get_ds(filelist, processor):
         ds = ArxivFigureCaptions(filelist)
     elif processor == "arxiv_equations":
         ds = ArxivEquations(filelist)
+    elif processor == "arxiv":
+        ds = ArxivFigureCaptions(filelist, extract=OUTPUTS[processor])
     else:
         raise ValueError(processor)
     return ds
 
 
-def get_fn(filelist, processor):
-    if processor  in ("biorxiv", "medarxiv"):
-        return parse_meca_to_list, {}
+def get_parser(processor, pdf_workers=4, pdf_size=1024, pdf_lookahead=1, ghostscript=False, render_cache=None, render_cache_memory=64e6, render_workers=0, tex_fallback=False, equation_filter=None, image_options=None, paper_guard=None, profile=None):
+    fn, kw = _get_parser(processor, pdf_workers, pdf_size, pdf_lookahead, ghostscript, render_cache, render_cache_memory, render_workers, tex_fallback, equation_filter, image_options, paper_guard)
+    if profile is not None:
+        # options of `profiling.Profiled`
+        fn = Profiled(fn, **profile)
+    return fn, kw
+
+
+def _get_parser(processor, pdf_workers, pdf_size, pdf_lookahead, ghostscript, render_cache, render_cache_memory, render_workers, tex_fallback, equation_filter, image_options, paper_guard):
+    if processor in ("biorxiv", "medarxiv"):
+        return parse_meca, {}
+    elif processor in ("pubmed",):
+        return parse_pubmed, {}
     elif processor == "arxiv_figure_captions":
-        return parse_arxiv_shard_tar_to_list, {"extract": "figure_captions"}
+        return parse_arxiv_shard_tar, {"extract": ["figure_captions"], "pdf_workers": pdf_workers, "pdf_size": pdf_size, "lookahead": pdf_lookahead, "ghostscript": ghostscript, **(image_options or {}), **(paper_guard or {})}
     elif processor == "arxiv_equations":
-        return parse_arxiv_shard_tar_to_list, {"extract": "math"}
+        return parse_arxiv_shard_tar, {"extract": ["math"], "render_cache": render_cache, "render_cache_memory": render_cache_memory, "render_workers": render_workers, "tex_fallback": tex_fallback, "equation_filter": equation_filter, **(paper_guard or {})}
+    elif processor == "arxiv":
+        return parse_arxiv_shard_tar, {
+            "extract": OUTPUTS[processor], "pdf_workers": pdf_workers, "pdf_size": pdf_size, "lookahead": pdf_lookahead, "ghostscript": ghostscript, **(image_options or {}),
+            "render_cache": render_cache, "render_cache_memory": render_cache_memory, "render_workers": render_workers,
+            "tex_fallback": tex_fallback, "equation_filter": equation_filter,
+            **(paper_guard or {}),
+        }
     else:
         raise ValueError(processor)
 
 
-def loader(filelist, num_workers=16, processor="meca"):
+def loader(filelist, num_workers=16, processor="meca", schedule="dynamic", **parser_options):
+    """
+    yield the samples extracted from `filelist` using `num_workers` DataLoader workers.
 
-
-    ds = get_ds(filelist, processor)
+    with `schedule="dynamic"`, workers pull files one by one from a shared queue and
+    their utilization is reported at the end, with `schedule="static"` each worker
+    gets a fixed contiguous slice of the file list.
+    """
+    queue = None
+    if schedule == "dynamic":
+        fn, kw = get_parser(processor, **parser_options)
+        queue = WorkQueue(filelist, num_workers)
+        ds = QueuedDataset(fn, queue, **kw)
+        init_fn = None
+    elif schedule == "static":
+        ds = get_ds(filelist, processor)
+        init_fn = worker_init_fn
+    else:
+        raise ValueError(schedule)
 
     bs = max(num_workers, 1)
     #dl = DataLoader(ds, num_workers=0, batch_size=bs, collate_fn=lambda x:x)
-    dl = DataLoader(ds, num_workers=num_workers, batch_size=bs, collate_fn=lambda x:x, worker_init_fn=worker_init_fn)
-    for batch in dl:
-        for fig_i in batch:
-            yield fig_i
+    dl = DataLoader(ds, num_workers=num_workers, batch_size=bs, collate_fn=lambda x:x, worker_init_fn=init_fn)
+    try:
+        for batch in dl:
+            for fig_i in batch:
+                yield fig_i
+    finally:
+        if queue is not None:
+            queue.print_report()
+            queue.close()
+
+
+def loader2(filelist, num_workers=16, processor="meca", **parser_options):
+    """
+    yield the samples extracted from `filelist` using a pool of `num_workers` processes
+    that keeps files in flight continuously and streams samples back in small chunks.
+    """
+    fn, kw = get_parser(processor, **parser_options)
+    yield from stream_map(fn, filelist, num_workers, **kw)
+
+
+def claim_equations(samples, dedup, on_duplicates):
+    """
+    yield `samples`, except the equations already written from another paper: the equations of a paper
+    are held until the paper ends (a sample of another paper or the end of its input), then claimed
+    in a single transaction (see `EquationFilter.claim`), `on_duplicates` being called with the number of dropped ones
+    """
+    # input -> (url, equations) of the paper being received from that input
+    pending = {}
 
+    def flush(source):
+        url, equations = pending.pop(source, (None, []))
+        kept = dedup.claim([data["caption"] for data in equations], url)
+        yield from (data for data, keep in zip(equations, kept) if keep)
+        if not all(kept):
+            on_duplicates(len(kept) - sum(kept))
 
-def loader2(filelist, num_workers=16, processor="meca"):
-    fn, kw = get_fn(filelist, processor)
-    with Parallel(n_jobs=num_workers, backend="multiprocessing") as parallel:
-        for i in range(0, len(filelist), num_workers):
-            fs = filelist[i:i+num_workers]
-            results = parallel(delayed(fn)(f, **kw) for f in fs)
-            for r in results:
-                yield from r
+    for data in samples:
+        source = data.get("__source__")
+        if data.get("__kind__") == "math":
+            if source in pending and pending[source][0] != data["url"]:
+                yield from flush(source)
+            pending.setdefault(source, (data["url"], []))[1].append(data)
+            continue
+        if "__done__" in data or "__failed__" in data:
+            yield from flush(data.get("__done__", data.get("__failed__")))
+        elif source in pending and "url" in data and data["url"] != pending[source][0]:
+            yield from flush(source)
+        yield data
+    for source in list(pending):
+        yield from flush(source)
 
 
-class ShuffledIter:
+KEYS_PER_RANK = 10**12
 
-    def __init__(self, data):
-        self.data = data
 
-    def __iter__(self):
-        while True:
-            random.shuffle(self.data)
-            yield from self.data
+def publish_manifest(path, path_shards):
+    """
+    the manifest of remote shards is written locally (it is appended to and fsync'ed),
+    a copy is put next to the shards once the extraction is done, where `merge` looks for it
+    """
+    if "://" not in path_shards:
+        return
+    with open(path, "rb") as src, fsspec.open(os.path.join(path_shards, os.path.basename(path)), "wb") as dst:
+        dst.write(src.read())
+
+
+def extract(filelist, *, start=0, nb:int=None, nb_shards=1, max_open_shards=64, shard_maxcount=100000, shard_maxsize:float=3e9, shuffle_buffer=0, path_shards=".", num_workers=1, processor="medarxiv", schedule="dynamic", backend="dataloader", writer="wds", total:int=None, chunk_size:int=None, seed=42, shard_prefix="shard", resume=False, manifest:str=None, rank:int=None, world_size:int=None, shards_per_rank=100000, pdf_workers=4, pdf_size=1024, pdf_lookahead=1, ghostscript=False, render_cache="render_cache.sqlite", render_cache_memory:float=64e6, render_workers=0, tex_fallback="auto", eq_min_length=1, eq_max_length=1000, eq_min_tokens=2, eq_max_tokens=500, eq_dedup="", image_format="png", image_quality:int=None, max_image_size:int=None, paper_timeout:float=600, paper_max_memory:float=None, paper_max_bytes:float=2e9, quarantine="quarantine.jsonl", metrics="metrics.jsonl", metrics_interval:float=60):
+    """
+    extract samples from the files listed in `filelist` into webdataset shards
+    `{path_shards}/{shard_prefix}-%05d.tar` (with more digits if the shard numbers of the ranks need them).
+    Processors producing several kinds of samples (`arxiv`: figure-caption pairs and equations,
+    from a single decode of each paper) write each kind to its own shards,
+    `{path_shards}/{shard_prefix}_{kind}-%05d.tar`, with its own manifest.
 
+    samples are spread over `nb_shards` shards written concurrently (at most `max_open_shards`
+    open at once), each rolling over to a new shard number after `shard_maxcount` samples
+    or `shard_maxsize` bytes. `shuffle_buffer` samples are buffered to shuffle the output.
 
-def extract(filelist, *, start=0, nb:int=None, nb_shards=1, path_shards=".", num_workers=1, processor="medarxiv", writer="wds", total:int=None, chunk_size:int=None, seed=42, shard_prefix="shard", resume=None):
+    PDF figures are rasterized to about `pdf_size` pixels (largest side), with at most
+    `pdf_workers` poppler processes per worker, in the background of the parsing:
+    the figures of the next `pdf_lookahead` arXiv papers are submitted before the samples of a paper are produced.
+    EPS/PS figures are rasterized the same way with persistent Ghostscript processes if `ghostscript`
+    (and Ghostscript is installed), and kept as they are otherwise.
+    Rendered equations are cached in memory (at most `render_cache_memory` bytes per process) and in the `render_cache` SQLite file,
+    shared by workers and runs (an empty string keeps the cache in memory only), in WAL mode on local filesystems
+    only: with several nodes, prefer a node-local path.
+    The equations of a paper are rendered as one batch, split across `render_workers` processes
+    if > 0 (only possible when the parsing runs in the main process, i.e. `num_workers=0`).
+    The equations mathtext can't render are rendered with pdflatex and pdftoppm when they are installed
+    and render a test equation (`tex_fallback="auto"`), `tex_fallback="off"` disables it.
+    Before rendering, equations with less than `eq_min_length` or more than `eq_max_length` characters,
+    less than `eq_min_tokens` or more than `eq_max_tokens` tokens, or unbalanced braces are dropped,
+    as well as duplicates within a paper, and across papers if `eq_dedup` is the path of a SQLite file
+    (an equation is kept for the first paper it is written from, off by default).
+    The cross-paper dedup is done here before writing the equations of each paper: equations of papers that are
+    quarantined or fail are not lost.
+    Figures made of several images are composited into one image, scaled down to at most `max_image_size`
+    pixels (largest side) if given, and encoded as `image_format` ("png", "webp" or "jpeg") with
+    `image_quality` (the compression level for PNG, the quality for WebP and JPEG).
+    The width and height of figures are written in the `json` field of the samples.
+    arXiv papers taking more than `paper_timeout` seconds, growing the RSS of their worker by more than `paper_max_memory` bytes,
+    more than `paper_max_bytes` bytes once decompressed, or raising an error are skipped, and
+    listed in the `quarantine` JSONL file (an empty string disables it).
+    The time spent in each stage of the pipeline (summed over all the workers) and counters
+    (papers, figures and equations found, emitted and dropped by reason) are appended every
+    `metrics_interval` seconds to the `metrics` JSONL file (an empty string disables it),
+    and printed at the end.
+    """
     random.seed(seed)
+    if resume and backend == "dataloader" and schedule == "static":
+        # static datasets do not tag their samples with their input, so nothing is recorded in the manifest
+        raise ValueError("resume is not supported with schedule=static")
+    if image_format not in CODECS:
+        raise ValueError(image_format)
+    tex_fallback = tex_fallback not in (False, "off", "no", "false", "0")
+    if tex_fallback and not has_tex_fallback():
+        print("pdflatex or pdftoppm is missing or can't render equations, tex_fallback is disabled")
+        tex_fallback = False
+    image_options = dict(image_format=image_format, image_quality=image_quality, max_image_size=max_image_size)
+    paper_guard = dict(paper_timeout=paper_timeout, paper_max_memory=paper_max_memory, max_bytes=paper_max_bytes, quarantine=quarantine or None)
+    equation_filter = dict(
+        min_length=eq_min_length, max_length=eq_max_length,
+        min_tokens=eq_min_tokens, max_tokens=eq_max_tokens, dedup=eq_dedup or None,
+    )
+    # claims the equations of each paper before they are written, see `claim_equations`
+    dedup = get_equation_filter(**equation_filter) if eq_dedup else None
     filelist = [f.strip() for f in open(filelist).readlines()]
     if nb is None:
         end = len(filelist)
     else:
         end = start + nb
     filelist = filelist[start:end]
+    rank, world_size = get_rank(rank, world_size)
+    filelist = partition(filelist, rank, world_size)
     print("Start", filelist)
+    kinds = OUTPUTS.get(processor, [None])
+    prefixes = {kind: shard_prefix if kind is None else f"{shard_prefix}_{kind}" for kind in kinds}
+    manifests = {}
+    for kind in kinds:
+        if manifest is None:
+            manifest_dir = path_shards if "://" not in path_shards else "."
+            suffix = f"-{rank:05d}" if world_size > 1 else ""
+            path = os.path.join(manifest_dir, f"{prefixes[kind]}_manifest{suffix}.jsonl")
+        else:
+            path = manifest if kind is None else f"{os.path.splitext(manifest)[0]}_{kind}.jsonl"
+        manifests[kind] = Manifest(path, resume=resume)
     if resume:
-        import re
-        names = re.findall("Finished \['(.+)'\]", open(resume).read())
-        names = set(names)
-        print("nb existing", len(names))
-        filelist = [fs for fs in filelist if fs not in names]
+        print("nb existing", min(len(m.done) for m in manifests.values()))
+        # an input is done once it is done for all the outputs
+        filelist = [fs for fs in filelist if not all(fs in m for m in manifests.values())]
+        # incomplete shards of the interrupted run, their samples will be written again
+        for m in manifests.values():
+            for shard in m.unclosed_shards():
+                fs, path = fsspec.core.url_to_fs(shard)
+                if fs.exists(path):
+                    print("Removing incomplete shard", shard)
+                    fs.rm(path)
     if not len(filelist):
+        for m in manifests.values():
+            m.close()
+            publish_manifest(m.path, path_shards)
         return
     random.shuffle(filelist)
-    fds = [
-        fsspec.open(os.path.join(path_shards, f"{shard_prefix}.tar"),"wb").open() for i in range(nb_shards)
-    ]
-    sinks = [TarWriter(fd, append=False) for fd in fds]
-    sink_iter = iter(ShuffledIter(sinks))
+    # shard numbers of all the ranks have the same number of digits, so that they sort
+    digits = max(5, len(str(world_size * shards_per_rank - 1))) if world_size > 1 else 5
+    sinks = {
+        kind: ShardWriterPool(
+            os.path.join(path_shards, f"{prefixes[kind]}-%0{digits}d.tar"),
+            nb_open=max(min(nb_shards, max_open_shards), 1),
+            maxcount=shard_maxcount,
+            maxsize=shard_maxsize,
+            shuffle_buffer=shuffle_buffer,
+            seed=seed,
+            start_shard=rank * shards_per_rank + len(m.shards),
+            end_shard=(rank + 1) * shards_per_rank if world_size > 1 else None,
+            post=m.shard_closed,
+            on_write=m.sample_written,
+        )
+        for kind, m in manifests.items()
+    }
+    # keys are unique across ranks as well
+    key_offset = max(max(m.max_key for m in manifests.values()) + 1, rank * KEYS_PER_RANK)
+    seen = defaultdict(int)
+    cache_counts = {"memory": 0, "disk": 0, "miss": 0}
+    render_failed = Counter()
+    cache_bytes_saved = 0
+    filter_counts = Counter()
+    nb_equations = 0
+    failed_inputs = []
     nb = 0
+    # metrics of all the workers, sent as `__stats__` records, and of the writing here
+    all_metrics = Metrics()
+
+    def on_duplicates(nb):
+        filter_counts["duplicate"] += nb
+        all_metrics.count("equations_dropped_filter", nb)
+
+    metrics_log = MetricsLog(metrics or None, interval=metrics_interval)
     t0 = time.time()
     BS = chunk_size if chunk_size else len(filelist)
     for i in range(0, len(filelist), BS):
         print(f"Processing filelist chunk from {i} to {i+BS},  current elapsed time = {time.time()-t0} seconds.")
-        for data in loader(filelist[i:i+BS], processor=processor, num_workers=num_workers):
-            key = str(nb)
+        if backend == "dataloader":
+            samples = loader(filelist[i:i+BS], processor=processor, num_workers=num_workers, schedule=schedule, pdf_workers=pdf_workers, pdf_size=pdf_size, pdf_lookahead=pdf_lookahead, ghostscript=ghostscript, render_cache=render_cache or None, render_cache_memory=render_cache_memory, render_workers=render_workers, tex_fallback=tex_fallback, equation_filter=equation_filter, image_options=image_options, paper_guard=paper_guard)
+        elif backend == "pool":
+            samples = loader2(filelist[i:i+BS], processor=processor, num_workers=num_workers, pdf_workers=pdf_workers, pdf_size=pdf_size, pdf_lookahead=pdf_lookahead, ghostscript=ghostscript, render_cache=render_cache or None, render_cache_memory=render_cache_memory, render_workers=render_workers, tex_fallback=tex_fallback, equation_filter=equation_filter, image_options=image_options, paper_guard=paper_guard)
+        else:
+            raise ValueError(backend)
+        if dedup is not None:
+            samples = claim_equations(samples, dedup, on_duplicates)
+        for data in samples:
+            if "__done__" in data:
+                for m in manifests.values():
+                    if data["__done__"] not in m:
+                        m.input_finished(data["__done__"])
+                continue
+            if "__failed__" in data:
+                # not recorded as done, with `resume` its samples that are not written yet are extracted again
+                failed_inputs.append(data["__failed__"])
+                continue
+            if "__stats__" in data:
+                nb_equations += data["__stats__"].get("equations", 0)
+                filter_counts.update(data["__stats__"].get("equation_filter", {}))
+                render_failed.update(data["__stats__"].get("render_failed", {}))
+                all_metrics.merge(data["__stats__"].get("metrics", {}))
+                metrics_log.maybe_write(all_metrics, nb)
+                continue
+            kind = data.pop("__kind__", None)
+            if kind not in sinks:
+                kind = None
+            kind_manifest, sink = manifests[kind], sinks[kind]
+            source = data.get("__source__")
+            # samples are identified by their paper and their index within the paper, given by the parser
+            # before anything is dropped (or counted here for the parsers that don't)
+            index = data.pop("__index__", None)
+            url = data.get("url")
+            if index is None:
+                index = seen[kind, source, url]
+                seen[kind, source, url] += 1
+            sample_id = f"{url}:{index}"
+            if source is not None:
+                # skip the samples that already made it to a closed shard before a resume
+                if source in kind_manifest or kind_manifest.is_written(source, sample_id):
+                    continue
+            cached = data.pop("__render_cache__", None)
+            if cached is not None:
+                cache_counts[cached] += 1
+                if cached != "miss":
+                    cache_bytes_saved += len(data["img_content"])
+            key = str(key_offset + nb)
             if "img_content" in data:
                 ext = os.path.splitext(data["img_path"])[-1].replace(".", "")
                 datum = {
@@ -128,12 +369,19 @@ def extract(filelist, *, start=0, nb:int=None, nb_shards=1, path_shards=".", num
                     ext: data["img_content"],
                     "txt": data["caption"],
                     "url": data["url"],
+                    "__id__": sample_id,
                 }
+                if source is not None:
+                    datum["__source__"] = source
+                if "width" in data:
+                    datum["json"] = {"width": data["width"], "height": data["height"]}
             else:
                 datum = data
                 datum['__key__'] = key
-            sink = next(sink_iter)
-            sink.write(datum)
+                datum['__id__'] = sample_id
+            kind_manifest.sample_queued(datum)
+            with all_metrics.timer("write"):
+                sink.write(datum)
             nb += 1
             if total and nb == total:
                 print("Total reached")
@@ -143,13 +391,80 @@ def extract(filelist, *, start=0, nb:int=None, nb_shards=1, path_shards=".", num
                 print(f"Number of samples written: {nb}, Speed: {nb/dt} samples/s")
         if total and nb == total:
             break
-    for s in sinks:
-        s.close()
-    for fd in fds:
-        fd.close()
+    for kind in kinds:
+        with all_metrics.timer("write"):
+            sinks[kind].close()
+        manifests[kind].close()
+        publish_manifest(manifests[kind].path, path_shards)
+    all_metrics.merge(get_metrics().pop())
+    metrics_log.maybe_write(all_metrics, nb, force=True)
+    print_filter_report(filter_counts, nb_equations)
+    print_cache_report(cache_counts, cache_bytes_saved, render_failed)
+    print(all_metrics.summary(time.time() - t0, nb))
+    if failed_inputs:
+        print(f"{len(failed_inputs)} inputs failed and are not recorded as done: {failed_inputs}")
     fs = str(filelist) if nb else None
     print(f"Finished {fs}, total samples written:", nb)
 
 
+def profile(filelist, *, nb:int=10, start=0, processor="arxiv", num_workers=0, backend="pool", output="profile", profiler="cprofile", memory=False, interval:float=0.01, top:int=20, pdf_workers=4, pdf_size=1024, render_cache="", render_workers=0, paper_timeout:float=600):
+    """
+    profile the parsing of `nb` inputs of `filelist` (from `start`) with `processor`, without writing any shard.
+
+    each input is processed under `profiler` ("cprofile", "pyinstrument" if installed, or "none") in its
+    worker process, while the stacks of all its threads are sampled every `interval` seconds.
+    With `memory`, allocations are traced with tracemalloc.
+    The results of the workers are merged into the `output` folder:
+    profile.prof (cProfile stats), profile.html and profile.speedscope.json (pyinstrument),
+    stacks.folded (collapsed stacks, for flamegraph.pl or speedscope), allocations.txt
+    (the `top` allocation sites at the memory peak of the inputs) and inputs.jsonl (time,
+    number of samples and peak memory of each input). The `top` slowest inputs and functions
+    (by cumulative time) are printed, as well as the metrics of the pipeline stages.
+    The render cache is in memory only by default, so that equations are actually rendered.
+    """
+    if profiler not in PROFILERS:
+        raise ValueError(profiler)
+    if profiler == "pyinstrument":
+        # fail before starting the workers
+        import pyinstrument
+    filelist = [f.strip() for f in open(filelist).readlines()][start:start + nb]
+    reset_output(output)
+    options = dict(
+        pdf_workers=pdf_workers, pdf_size=pdf_size, render_cache=render_cache or None, render_workers=render_workers,
+        equation_filter={}, paper_guard=dict(paper_timeout=paper_timeout),
+        profile=dict(output=output, profiler=profiler, memory=memory, interval=interval),
+    )
+    if backend == "dataloader":
+        samples = loader(filelist, processor=processor, num_workers=num_workers, **options)
+    elif backend == "pool":
+        samples = loader2(filelist, processor=processor, num_workers=num_workers, **options)
+    else:
+        raise ValueError(backend)
+    all_metrics = Metrics()
+    nb_samples = 0
+    t0 = time.time()
+    for data in samples:
+        if "__stats__" in data:
+            all_metrics.merge(data["__stats__"].get("metrics", {}))
+        elif "__done__" not in data and "__failed__" not in data:
+            nb_samples += 1
+    all_metrics.merge(get_metrics().pop())
+    merge_profiles(output, top=top)
+    print(all_metrics.summary(time.time() - t0, nb_samples))
+
+
+def merge(path_shards=".", *, shard_prefix="shard", output:str=None):
+    """
+    merge the per-rank manifests written by a multi-rank `extract` into a single manifest
+    (default: `{path_shards}/{shard_prefix}_manifest.jsonl`)
+    """
+    fs, root = fsspec.core.url_to_fs(path_shards)
+    paths = sorted(fs.unstrip_protocol(p) for p in fs.glob(os.path.join(root, f"{shard_prefix}_manifest-*.jsonl")))
+    if output is None:
+        output = os.path.join(path_shards, f"{shard_prefix}_manifest.jsonl")
+    merged = merge_manifests(paths, output)
+    print(f"Merged {len(paths)} manifests into {output}: {len(merged.done)} inputs, {len(merged.closed)} shards, {merged.nb_samples()} samples")
+
+
 if __name__ == "__main__":
-    run([extract])
+    run([extract, merge, profile])
@@ -0,0 +1,222 @@
+import os
+import json
+import fsspec
+from collections import defaultdict
+
+
+class Manifest:
+    """
+    append-only JSONL journal of an extraction, used to resume it.
+
+    Three kinds of records are appended, each one flushed and fsync'ed on its own line:
+
+    - `{"open": shard}`: the first sample was written to `shard`
+    - `{"shard": shard, "inputs": {input: nb_samples}, "ids": {input: [id, ...]}, "max_key": key}`:
+      `shard` was closed, with the number of samples it holds for each input and their id (`__id__`)
+    - `{"input": input, "samples": nb_samples, "shards": [...]}`: the input was fully processed
+      and all the shards holding its samples are closed
+
+    On resume, done inputs are skipped, and for inputs that were interrupted the ids of the samples
+    that already made it to a closed shard are known (see `is_written`), so that exactly those are not
+    written again, whatever the order in which samples were spread over shards (several open shards,
+    shuffle buffer). The id of a sample is "<paper url>:<index within the paper>", the index being
+    assigned by the parser before any sample is dropped, so that it does not depend on papers that
+    hit their budget or on equations claimed by other papers.
+    Shards that were opened but never closed are incomplete and can be removed (see `unclosed_shards`).
+    With `path=None`, the manifest is only kept in memory.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        # input -> record, for the inputs that are done
+        self.done = {}
+        # input -> nb of samples in closed shards, for the inputs that are not done
+        self.written = defaultdict(int)
+        self.written_shards = defaultdict(set)
+        self.written_ids = defaultdict(set)
+        self.shards = []
+        self.closed = set()
+        self.max_key = -1
+        if path is None:
+            self.fd = None
+        elif resume and os.path.exists(path):
+            self.load()
+            self.fd = open(path, "a")
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.fd = open(path, "w")
+        # shard -> input -> ids of its samples, for the shards currently open
+        self.shard_inputs = defaultdict(lambda: defaultdict(list))
+        # input -> {"samples", "shards", "queued", "finished"}, for the inputs not committed yet
+        self.pending = {}
+
+    def load(self):
+        with open(self.path, "rb") as fd:
+            data = fd.read()
+        records, end = parse_records(data)
+        # drop a record torn by a crash, before appending new ones
+        if end != len(data):
+            with open(self.path, "r+b") as fd:
+                fd.truncate(end)
+        for record in records:
+            self.add(record)
+
+    def add(self, record):
+        """
+        update the state with a record read from a manifest
+        """
+        if "open" in record:
+            self.shards.append(record["open"])
+        elif "shard" in record:
+            self.closed.add(record["shard"])
+            self.max_key = max(self.max_key, record["max_key"])
+            ids = record.get("ids", {})
+            for name, nb in record["inputs"].items():
+                if name not in self.done:
+                    self.written_ids[name].update(ids.get(name, ()))
+                    self.written[name] += nb
+                    self.written_shards[name].add(record["shard"])
+        elif "input" in record:
+            self.done[record["input"]] = record
+            self.written.pop(record["input"], None)
+            self.written_shards.pop(record["input"], None)
+            self.written_ids.pop(record["input"], None)
+
+    def append(self, record):
+        if self.fd is None:
+            return
+        self.fd.write(json.dumps(record) + "\n")
+        self.fd.flush()
+        os.fsync(self.fd.fileno())
+
+    def __contains__(self, name):
+        return name in self.done
+
+    def nb_written(self, name):
+        """
+        number of samples of an input that are already in closed shards
+        """
+        return self.written.get(name, 0)
+
+    def is_written(self, name, sample_id):
+        """
+        whether the sample `sample_id` of an input is already in a closed shard
+        """
+        return sample_id in self.written_ids.get(name, ())
+
+    def unclosed_shards(self):
+        return [s for s in self.shards if s not in self.closed]
+
+    def nb_samples(self):
+        return sum(r["samples"] for r in self.done.values()) + sum(self.written.values())
+
+    def get_pending(self, name):
+        if name not in self.pending:
+            self.pending[name] = {
+                "samples": self.written.get(name, 0),
+                "shards": set(self.written_shards.get(name, ())),
+                "queued": 0,
+                "finished": False,
+            }
+        return self.pending[name]
+
+    def sample_queued(self, sample):
+        """
+        to be called each time a sample is handed to the writer, which might buffer it
+        """
+        name = sample.get("__source__")
+        if name is not None:
+            self.get_pending(name)["queued"] += 1
+
+    def sample_written(self, sample, shard):
+        """
+        to be called each time a sample is written to a shard
+        """
+        if shard not in self.shard_inputs:
+            self.shards.append(shard)
+            self.append({"open": shard})
+            self.shard_inputs[shard] = defaultdict(list)
+        self.max_key = max(self.max_key, int(sample["__key__"]))
+        name = sample.get("__source__")
+        if name is None:
+            return
+        self.shard_inputs[shard][name].append(sample["__id__"])
+        p = self.get_pending(name)
+        p["queued"] -= 1
+        p["samples"] += 1
+        p["shards"].add(shard)
+
+    def shard_closed(self, shard):
+        """
+        to be called each time a shard is closed
+        """
+        inputs = self.shard_inputs.pop(shard, {})
+        self.closed.add(shard)
+        self.append({
+            "shard": shard,
+            "inputs": {name: len(ids) for name, ids in inputs.items()},
+            "ids": dict(inputs),
+            "max_key": self.max_key,
+        })
+        for name in inputs:
+            self.commit(name)
+
+    def input_finished(self, name):
+        """
+        to be called once all the samples of an input were written
+        """
+        self.get_pending(name)["finished"] = True
+        self.commit(name)
+
+    def commit(self, name):
+        p = self.pending.get(name)
+        if p is None or not p["finished"] or p["queued"]:
+            return
+        if any(s not in self.closed for s in p["shards"]):
+            return
+        record = {"input": name, "samples": p["samples"], "shards": sorted(p["shards"])}
+        self.append(record)
+        self.done[name] = record
+        self.written.pop(name, None)
+        self.written_shards.pop(name, None)
+        self.written_ids.pop(name, None)
+        del self.pending[name]
+
+    def close(self):
+        if self.fd is not None:
+            self.fd.close()
+
+
+def parse_records(data):
+    """
+    return (records, end) for the contents of a manifest, a last record torn by a crash
+    (after `end`) being ignored
+    """
+    end = data.rfind(b"\n") + 1
+    return [json.loads(line) for line in data[:end].splitlines()], end
+
+
+def merge_manifests(paths, output):
+    """
+    merge the manifests of several ranks (writing disjoint shards) into a single one,
+    keeping only closed shards and done inputs.
+    Manifests are read and written with fsspec, so they can be next to remote shards.
+    Returns the merged manifest (in memory).
+    """
+    merged = Manifest(None)
+    lines = []
+    for path in paths:
+        with fsspec.open(path, "rb") as fd:
+            records, _ = parse_records(fd.read())
+        for record in records:
+            if "open" in record:
+                continue
+            if "input" in record:
+                assert record["input"] not in merged.done, f"{record['input']} was processed by two ranks"
+            else:
+                merged.shards.append(record["shard"])
+            merged.add(record)
+            lines.append(json.dumps(record) + "\n")
+    with fsspec.open(output, "w") as fd:
+        fd.writelines(lines)
+    return merged
@@ -8,61 +8,66 @@ from clize import run
 import random
 import os
 import zipfile
-import pubmed_parser as pp
 import fsspec
 
 from writer import TarWriter
+from metrics import timer, count, stats_record
+from pubmed import parse_figures
 import io
 from joblib import Parallel, delayed
 
 
-def parse_meca_to_list(path):
-    return list(parse_meca(path))
+def parse_meca_to_list(path, ranged=True):
+    return list(parse_meca(path, ranged=ranged))
 
-def parse_meca(path):
-    output = []
-    of = fsspec.open(path)
-    with of as fd:
-        data = fd.read()
-    of.close()
-    fd = io.BytesIO(data)
-    t0 = time.time()
-    with zipfile.ZipFile(fd, mode='r') as zip_file:
-        for f in zip_file.filelist:
-            if not f.filename.startswith("content/"):
-                continue
-            if not f.filename.endswith(".xml"):
-                continue
-            with zip_file.open(f.filename) as xml_file:
-                try:
-                    dicts_out = pp.parse_pubmed_caption(xml_file)
-                except AttributeError:
-                    continue
-                except ValueError:
-                    continue
-                except Exception:
-                    continue
-            if not dicts_out:
-                continue
-            for fig in dicts_out:
-                caption = fig['fig_caption']
-                graphic_ref = fig['graphic_ref']
-                if graphic_ref is None:
-                    continue
-                if caption is None:
-                    continue
-                img_path  = "content/" + graphic_ref
-                try:
-                    with zip_file.open(img_path) as img_file:
-                        img_content = img_file.read()
-                except Exception:
-                    continue
-                datum = {"url": path, "caption": caption, "img_content": img_content, "img_path": img_path}
-                #print(caption, len(img_content), img_path)
-                #output.append(datum)
-                yield datum 
-    #print(time.time() - t0)
-    #return output
+def parse_meca(path, ranged=True, block_size=1024 * 1024):
+    """
+    extract figure/caption pairs from a .meca (zip) file
+
+    with `ranged=True` the zip is opened as a seekable fsspec file with block caching:
+    only the central directory, the `content/*.xml` entries and the images they
+    reference are fetched, the rest of the archive (videos, pdfs, ...) is never transferred.
+    Otherwise the whole file is downloaded first.
+    """
+    if ranged:
+        with fsspec.open(path, mode="rb", block_size=block_size, cache_type="blockcache") as fd:
+            with zipfile.ZipFile(fd, mode='r') as zip_file:
+                yield from parse_meca_zip(zip_file, path)
+    else:
+        of = fsspec.open(path)
+        with of as fd, timer("download"):
+            data = fd.read()
+        of.close()
+        fd = io.BytesIO(data)
+        with zipfile.ZipFile(fd, mode='r') as zip_file:
+            yield from parse_meca_zip(zip_file, path)
+
+def parse_meca_zip(zip_file, path):
+    # parse all the captions first, so that image entries are only read afterwards
+    count("papers")
+    figs = []
+    for f in zip_file.filelist:
+        if not f.filename.startswith("content/"):
+            continue
+        if not f.filename.endswith(".xml"):
+            continue
+        # with a ranged file, only the .xml entry is downloaded
+        with zip_file.open(f.filename) as xml_file, timer("download"):
+            xml_content = xml_file.read()
+        for graphic_ref, caption in parse_figures(xml_content):
+            figs.append((caption, "content/" + graphic_ref))
+    names = set(zip_file.namelist())
+    for caption, img_path in figs:
+        if img_path not in names:
+            continue
+        try:
+            with zip_file.open(img_path) as img_file, timer("download"):
+                img_content = img_file.read()
+        except Exception:
+            continue
+        datum = {"url": path, "caption": caption, "img_content": img_content, "img_path": img_path}
+        count("figures_emitted")
+        yield datum 
 
 class MecaDataset:
 
@@ -94,4 +99,5 @@ class MecaIterableDataset(torch.utils.data.IterableDataset):
                 yield from parse_meca(fs)
             except Exception as ex:
                 print(ex)
+            yield stats_record()
 
@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+# pipeline stages, in order, for the reports
+STAGES = ("download", "decompress", "parse_latex", "parse_xml", "rasterize", "render_equations", "encode", "write")
+
+
+class Metrics:
+    """
+    per-stage timers (total seconds and number of calls) and counters of a process.
+
+    Worker processes periodically `pop` what they recorded since the last time and send it to the
+    main process (see `scheduler.tag_source`), which `merge`s it with its own metrics.
+    Thread-safe, as figures are rasterized in background threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.seconds = defaultdict(float)
+        self.calls = Counter()
+        self.counters = Counter()
+
+    @contextmanager
+    def timer(self, stage):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - t0)
+
+    def add_time(self, stage, seconds, calls=1):
+        with self.lock:
+            self.seconds[stage] += seconds
+            self.calls[stage] += calls
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def snapshot(self, reset=False):
+        """
+        JSON-serializable copy of the metrics, reset afterwards if `reset`
+        """
+        with self.lock:
+            snapshot = {
+                "timers": {stage: [self.seconds[stage], self.calls[stage]] for stage in self.seconds},
+                "counters": dict(self.counters),
+            }
+            if reset:
+                self.reset()
+        return snapshot
+
+    def pop(self):
+        """
+        return what was recorded since the last `pop` and reset
+        """
+        return self.snapshot(reset=True)
+
+    def merge(self, snapshot):
+        for stage, (seconds, calls) in snapshot.get("timers", {}).items():
+            self.add_time(stage, seconds, calls)
+        with self.lock:
+            self.counters.update(snapshot.get("counters", {}))
+
+    def summary(self, elapsed, nb_samples=None):
+        """
+        human readable report, the time of each stage being summed over all the workers
+        (and over the rasterization threads, so stages can add up to more than the wall-clock time)
+        """
+        lines = []
+        if nb_samples is not None and elapsed:
+            lines.append(f"Throughput: {nb_samples} samples in {elapsed:.1f}s ({nb_samples/elapsed:.1f} samples/s)")
+        if self.counters["papers"] and elapsed:
+            lines.append(f"Papers: {self.counters['papers']} ({self.counters['papers']/elapsed:.2f} papers/s)")
+        total = sum(self.seconds.values())
+        stages = [s for s in STAGES if s in self.seconds] + sorted(s for s in self.seconds if s not in STAGES)
+        for stage in stages:
+            seconds, calls = self.seconds[stage], self.calls[stage]
+            share = 100 * seconds / total if total else 0
+            lines.append(f"  {stage}: {seconds:.1f}s ({share:.1f}%), {calls} calls, {1000*seconds/max(calls, 1):.2f} ms/call")
+        for name in sorted(self.counters):
+            lines.append(f"  {name}: {self.counters[name]}")
+        return "\n".join(lines)
+
+
+_metrics = None
+_pid = None
+
+
+def get_metrics():
+    """
+    metrics of the current process (a forked worker starts from empty metrics)
+    """
+    global _metrics, _pid
+    if _metrics is None or _pid != os.getpid():
+        _metrics = Metrics()
+        _pid = os.getpid()
+    return _metrics
+
+
+def timer(stage):
+    return get_metrics().timer(stage)
+
+
+def count(name, n=1):
+    get_metrics().count(name, n)
+
+
+def stats_record():
+    """
+    record sending the metrics of the current process to the main process (and resetting them),
+    yielded along with the samples
+    """
+    return {"__stats__": {"metrics": get_metrics().pop()}}
+
+
+class MetricsLog:
+    """
+    appends the cumulated metrics of an extraction to a JSONL file, at most every `interval` seconds
+    """
+
+    def __init__(self, path, interval=60):
+        self.path = path
+        self.interval = interval
+        self.t0 = time.time()
+        self.last = self.t0
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def maybe_write(self, metrics, nb_samples, force=False):
+        now = time.time()
+        if not self.path or (not force and now - self.last < self.interval):
+            return
+        self.last = now
+        record = {"time": now, "elapsed": now - self.t0, "samples": nb_samples, **metrics.snapshot()}
+        with open(self.path, "a") as fd:
+            fd.write(json.dumps(record) + "\n")
@@ -0,0 +1,249 @@
+"""
+Profiling of the parsers, used by `main.py profile`.
+
+`Profiled` wraps a parsing function so that each input is processed under a profiler, in whatever
+process (DataLoader or `stream_map` worker) it runs. Each worker writes its results for each input
+to `{output}/workers/`, and `merge_profiles` merges them once all the inputs are done.
+"""
+import os
+import re
+import sys
+import glob
+import json
+import time
+import pstats
+import shutil
+import itertools
+import threading
+import tracemalloc
+from collections import Counter
+from functools import reduce
+
+PROFILERS = ("cprofile", "pyinstrument", "none")
+THREAD_NUMBER = re.compile(r"[-_]\d+")
+
+# allocations made by the import system and by the profiling itself are not reported
+IGNORED_ALLOCATIONS = [
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+]
+
+_nb_inputs = itertools.count()
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ",")
+
+
+class StackSampler:
+    """
+    samples the Python stack of every thread (but its own) every `interval` seconds from a background
+    thread, and counts them as collapsed stacks ("thread;caller;...;callee" -> number of samples),
+    the input format of flamegraph.pl and speedscope. Unlike cProfile, it sees the threads the
+    parsers start (e.g. the rasterizer).
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        me = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame))
+                    frame = frame.f_back
+                # threads of a pool are merged together
+                stack.append(THREAD_NUMBER.sub("", names.get(ident, "thread")))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def start_profiler(profiler):
+    if profiler == "cprofile":
+        import cProfile
+        prof = cProfile.Profile()
+        prof.enable()
+        return prof
+    elif profiler == "pyinstrument":
+        from pyinstrument import Profiler
+        prof = Profiler()
+        prof.start()
+        return prof
+    elif profiler == "none":
+        return None
+    else:
+        raise ValueError(profiler)
+
+
+def stop_profiler(prof, profiler, path):
+    if profiler == "cprofile":
+        prof.disable()
+        prof.dump_stats(path + ".prof")
+    elif profiler == "pyinstrument":
+        prof.stop().save(path + ".pyisession")
+
+
+class Profiled:
+    """
+    parsing function `fn` (a generator of samples) running each input under `profiler`
+    ("cprofile", "pyinstrument" or "none", only the thread processing the input is profiled) and
+    a `StackSampler`. With `memory=True`, allocations are traced with `tracemalloc`, and the allocation
+    sites holding the most memory at the highest traced memory seen between two samples of the input
+    (compared to when the input started) are written, `nb_allocations` of them.
+    """
+
+    def __init__(self, fn, output, profiler="cprofile", memory=False, interval=0.01, nb_allocations=100):
+        self.fn = fn
+        self.nb_allocations = nb_allocations
+        self.output = output
+        self.profiler = profiler
+        self.memory = memory
+        self.interval = interval
+
+    def __call__(self, item, **kw):
+        workers_dir = os.path.join(self.output, "workers")
+        os.makedirs(workers_dir, exist_ok=True)
+        path = os.path.join(workers_dir, f"{os.getpid()}-{next(_nb_inputs)}")
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            start = tracemalloc.take_snapshot()
+        peak, snapshot = 0, None
+        nb = 0
+        sampler = StackSampler(self.interval)
+        sampler.start()
+        prof = start_profiler(self.profiler)
+        t0 = time.perf_counter()
+        try:
+            for sample in self.fn(item, **kw):
+                nb += 1
+                if self.memory:
+                    current, _ = tracemalloc.get_traced_memory()
+                    # snapshots are slow, only take one when the memory grew significantly
+                    if current > 1.1 * peak:
+                        peak = current
+                        snapshot = tracemalloc.take_snapshot()
+                yield sample
+        finally:
+            seconds = time.perf_counter() - t0
+            stop_profiler(prof, self.profiler, path)
+            sampler.stop()
+            with open(path + ".folded", "w") as fd:
+                for stack, n in sampler.stacks.items():
+                    fd.write(f"{stack} {n}\n")
+            record = {"input": item, "name": os.path.basename(path), "pid": os.getpid(), "seconds": seconds, "samples": nb}
+            if self.memory:
+                record["peak_memory"] = tracemalloc.get_traced_memory()[1]
+                if snapshot is not None:
+                    stats = snapshot.filter_traces(IGNORED_ALLOCATIONS).compare_to(start.filter_traces(IGNORED_ALLOCATIONS), "lineno")
+                    allocations = [(str(s.traceback[0]), s.size_diff, s.count_diff) for s in stats if s.size_diff > 0]
+                    with open(path + ".allocations.json", "w") as fd:
+                        json.dump(allocations[:self.nb_allocations], fd)
+            with open(os.path.join(self.output, "inputs.jsonl"), "a") as fd:
+                fd.write(json.dumps(record) + "\n")
+
+
+def reset_output(output):
+    # results of a previous run would be merged with the new ones
+    shutil.rmtree(os.path.join(output, "workers"), ignore_errors=True)
+    if os.path.exists(os.path.join(output, "inputs.jsonl")):
+        os.remove(os.path.join(output, "inputs.jsonl"))
+    os.makedirs(output, exist_ok=True)
+
+
+def merge_folded(paths, output):
+    stacks = Counter()
+    for path in paths:
+        with open(path) as fd:
+            for line in fd:
+                stack, _, n = line.rstrip("\n").rpartition(" ")
+                stacks[stack] += int(n)
+    with open(output, "w") as fd:
+        for stack, n in sorted(stacks.items()):
+            fd.write(f"{stack} {n}\n")
+    return stacks
+
+
+def allocation_report(paths, inputs=None, top=20):
+    """
+    the `top` allocation sites (file:line) holding the most memory at the peak of an input,
+    over all the inputs, with the input where it was reached (`inputs` maps the names of the
+    worker results to their input)
+    """
+    inputs = inputs or {}
+    sites = {}
+    for path in paths:
+        name = os.path.basename(path)[:-len(".allocations.json")]
+        name = inputs.get(name, name)
+        with open(path) as fd:
+            allocations = json.load(fd)
+        for site, size, nb in allocations:
+            if site not in sites or size > sites[site][0]:
+                sites[site] = (size, nb, name)
+    lines = []
+    for site, (size, nb, name) in sorted(sites.items(), key=lambda kv: -kv[1][0])[:top]:
+        lines.append(f"{size/1e6:10.2f} MB {nb:9d} blocks  {site}  ({name})")
+    return "\n".join(lines)
+
+
+def merge_profiles(output, top=20):
+    """
+    merge the results written by the workers into `output`: profile.prof (cProfile, for snakeviz or pstats),
+    profile.html and profile.speedscope.json (pyinstrument), stacks.folded (collapsed stacks, for
+    flamegraph.pl or speedscope) and allocations.txt (with `memory=True`), and print the reports
+    """
+    workers_dir = os.path.join(output, "workers")
+    inputs = []
+    if os.path.exists(os.path.join(output, "inputs.jsonl")):
+        with open(os.path.join(output, "inputs.jsonl")) as fd:
+            inputs = [json.loads(line) for line in fd]
+    print(f"Slowest inputs (out of {len(inputs)}):")
+    for record in sorted(inputs, key=lambda r: -r["seconds"])[:top]:
+        memory = f", peak traced memory {record['peak_memory']/1e6:.1f} MB" if "peak_memory" in record else ""
+        print(f"  {record['input']}: {record['seconds']:.2f}s, {record['samples']} samples{memory}")
+
+    paths = sorted(glob.glob(os.path.join(workers_dir, "*.prof")))
+    if paths:
+        stats = pstats.Stats(*paths)
+        stats.dump_stats(os.path.join(output, "profile.prof"))
+        stats.sort_stats("cumulative").print_stats(top)
+
+    paths = sorted(glob.glob(os.path.join(workers_dir, "*.pyisession")))
+    if paths:
+        from pyinstrument.session import Session
+        from pyinstrument.renderers import HTMLRenderer, SpeedscopeRenderer
+        session = reduce(Session.combine, [Session.load(path) for path in paths])
+        with open(os.path.join(output, "profile.html"), "w") as fd:
+            fd.write(HTMLRenderer().render(session))
+        with open(os.path.join(output, "profile.speedscope.json"), "w") as fd:
+            fd.write(SpeedscopeRenderer().render(session))
+
+    paths = sorted(glob.glob(os.path.join(workers_dir, "*.folded")))
+    stacks = merge_folded(paths, os.path.join(output, "stacks.folded"))
+    print(f"{sum(stacks.values())} stack samples written to {os.path.join(output, 'stacks.folded')}")
+
+    paths = sorted(glob.glob(os.path.join(workers_dir, "*.allocations.json")))
+    if paths:
+        report = allocation_report(paths, inputs={r["name"]: r["input"] for r in inputs}, top=top)
+        with open(os.path.join(output, "allocations.txt"), "w") as fd:
+            fd.write(report + "\n")
+        print(f"Top {top} allocation sites at the memory peak of the inputs:")
+        print(report)
@@ -1,4 +1,5 @@
 import tarfile
+from collections import defaultdict
 import math
 import torch
 import time
@@ -12,17 +13,123 @@ import pubmed_parser as pp
 import fsspec
 
 from writer import TarWriter
+from metrics import timer, count, stats_record
 import io
 from joblib import Parallel, delayed
 
 
-def parse_pubmed_to_list(path):
-    return list(parse_pubmed(path))
+def parse_pubmed_to_list(path, stream=True):
+    return list(parse_pubmed(path, stream=stream))
 
 
-def parse_pubmed(path):
+def parse_pubmed(path, stream=True, max_buffer_bytes=256 * 1024 * 1024):
+    """
+    extract figure/caption pairs from a PMC OA package (.tar.gz)
+
+    with `stream=True` the package is read in a single pass (see `parse_pubmed_stream`),
+    otherwise it is fully downloaded and indexed first.
+    """
+    if stream:
+        yield from parse_pubmed_stream(path, max_buffer_bytes=max_buffer_bytes)
+    else:
+        yield from _parse_pubmed_in_memory(path)
+
+
+def parse_figures(xml_content):
+    """
+    return the (graphic_ref, caption) pairs of an .nxml file, skipping figures without any of them
+    """
+    try:
+        with timer("parse_xml"):
+            dicts_out = pp.parse_pubmed_caption(xml_content)
+    except AttributeError:
+        return []
+    except ValueError:
+        return []
+    except Exception:
+        return []
+    if not dicts_out:
+        return []
+    figs = []
+    for fig in dicts_out:
+        caption = fig['fig_caption']
+        graphic_ref = fig['graphic_ref']
+        if graphic_ref is None:
+            continue
+        if caption is None:
+            continue
+        figs.append((graphic_ref, caption))
+    count("figures_found", len(figs))
+    return figs
+
+
+def parse_pubmed_stream(path, max_buffer_bytes=256 * 1024 * 1024):
+    """
+    single pass over a PMC OA package, members are read in archive order
+    straight from the (decompressing) fsspec stream.
+
+    The samples are the same as `_parse_pubmed_in_memory`: each figure of each .nxml gets the last .jpg
+    with the name it references, or else the last .png, and they are yielded in the same order,
+    once the package is read. Only images are kept in memory: those referenced by a .nxml already read,
+    and up to `max_buffer_bytes` of the others, in case a later .nxml references them (beyond that,
+    the figures referencing them are dropped).
+    """
+    # image name without extension -> {"jpg"/"png": (basename, content)}, content is None if it was not read
+    images = defaultdict(dict)
+    buffered_bytes = 0
+    # (graphic_ref, caption) of all the .nxml, in order
+    figures = []
+    wanted = set()
+    with fsspec.open(path) as fd:
+        with tarfile.open(fileobj=fd, mode="r|gz") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                if member.name.endswith(".nxml"):
+                    # in a stream, members are downloaded and decompressed at once
+                    with timer("decompress"):
+                        mfd = tar.extractfile(member)
+                        xml_content = mfd.read()
+                        mfd.close()
+                    count("papers")
+                    figs = parse_figures(xml_content)
+                    figures.extend(figs)
+                    wanted.update(graphic_ref for graphic_ref, caption in figs)
+                    continue
+                # same names as `_parse_pubmed_in_memory`
+                if member.name.endswith("jpg"):
+                    ext, name = "jpg", os.path.basename(member.name).replace('.jpg', '')
+                elif member.name.endswith("png"):
+                    ext, name = "png", os.path.basename(member.name).replace('.png', '')
+                else:
+                    continue
+                img_path = os.path.basename(member.name)
+                if name not in wanted:
+                    if buffered_bytes + member.size > max_buffer_bytes:
+                        # dropped rather than replaced by another file with the same name
+                        images[name][ext] = (img_path, None)
+                        continue
+                    buffered_bytes += member.size
+                try:
+                    with timer("decompress"):
+                        mfd = tar.extractfile(member)
+                        img_content = mfd.read()
+                        mfd.close()
+                except Exception:
+                    img_content = None
+                images[name][ext] = (img_path, img_content)
+    for graphic_ref, caption in figures:
+        candidates = images.get(graphic_ref, {})
+        img_path, img_content = candidates.get("jpg") or candidates.get("png") or (None, None)
+        if img_content is None:
+            continue
+        count("figures_emitted")
+        yield {"url": path, "caption": caption, "img_content": img_content, "img_path": img_path}
+
+
+def _parse_pubmed_in_memory(path):
     of = fsspec.open(path)
-    with of as fd:
+    with of as fd, timer("download"):
         data = fd.read()
     of.close()
     fd = io.BytesIO(data)
@@ -39,23 +146,8 @@ def parse_pubmed(path):
         mfd = tar.extractfile(f)
         xml_content = mfd.read()
         mfd.close()
-        try:
-            dicts_out = pp.parse_pubmed_caption(xml_content)
-        except AttributeError:
-            continue
-        except ValueError:
-            continue
-        except Exception:
-            continue
-        if not dicts_out:
-            continue
-        for fig in dicts_out:
-            caption = fig['fig_caption']
-            graphic_ref = fig['graphic_ref']
-            if graphic_ref is None:
-                continue
-            if caption is None:
-                continue
+        count("papers")
+        for graphic_ref, caption in parse_figures(xml_content):
             img_path  = graphic_ref
             if img_path in member_by_name_jpg:
                 member = member_by_name_jpg[img_path]
@@ -66,12 +158,14 @@ def parse_pubmed(path):
             else:
                 continue
             try:
-                mfd = tar.extractfile(member)
-                img_content = mfd.read()
-                mfd.close()
+                with timer("decompress"):
+                    mfd = tar.extractfile(member)
+                    img_content = mfd.read()
+                    mfd.close()
             except Exception:
                 continue
             datum = {"url": path, "caption": caption, "img_content": img_content, "img_path": img_path}
+            count("figures_emitted")
             yield datum 
 
 
@@ -93,4 +187,5 @@ class PubMedIterableDataset(torch.utils.data.IterableDataset):
                 yield from parse_pubmed(fs)
             except Exception as ex:
                 print(ex)
+            yield stats_record()
 
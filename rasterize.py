@@ -0,0 +1,281 @@
+import os
+import re
+import time
+import queue
+import shutil
+import select
+import tempfile
+import threading
+import subprocess
+import multiprocessing.util
+from concurrent.futures import ThreadPoolExecutor
+from pdf2image import convert_from_bytes, pdfinfo_from_bytes
+
+from image_probe import bounding_box, postscript_section
+from metrics import timer
+
+PAGES_COUNT = re.compile(rb"/Type\s*/Pages\b[^>]*?/Count\s+(\d+)|/Count\s+(\d+)[^>]*?/Type\s*/Pages\b")
+MEDIA_BOX = re.compile(rb"/MediaBox\s*\[\s*([-+\d.]+)\s+([-+\d.]+)\s+([-+\d.]+)\s+([-+\d.]+)\s*\]")
+PAGE_SIZE = re.compile(r"([\d.]+)\s*x\s*([\d.]+)")
+# page of PostScript files without bounding box (US letter)
+DEFAULT_BOX = (0, 0, 612, 792)
+POSTSCRIPT_EXTENSIONS = (".eps", ".ps")
+
+# a Ghostscript job: the file is drawn on a page of the size of its bounding box, `showpage` is
+# disabled while it runs so that each job is exactly one page, and a status line is printed
+# once the page is written
+GS_JOB = """<< /PageSize [%(width)f %(height)f] /HWResolution [%(dpi)d %(dpi)d] >> setpagedevice
+userdict /showpage {} put
+gsave %(x0)f neg %(y0)f neg translate
+{ (%(path)s) run } stopped { (%%%%pp-error %(job)d\\n) } { (%%%%pp-ok %(job)d\\n) } ifelse
+grestore
+userdict /showpage undef
+systemdict /showpage get exec
+print flush
+clear cleardictstack
+"""
+
+
+def pdf_info(data, timeout=10):
+    """
+    return (nb_pages, (width, height)) of a PDF, the size being the one of the first page in points.
+    Both are read from the uncompressed page tree when possible, which does not need to run poppler,
+    otherwise (e.g. page tree in compressed object streams) `pdfinfo` is used.
+    Returns None if the PDF can't be read.
+    """
+    counts = [int(a or b) for a, b in PAGES_COUNT.findall(data)]
+    box = MEDIA_BOX.search(data)
+    if counts and box:
+        x0, y0, x1, y1 = (float(v) for v in box.groups())
+        return max(counts), (abs(x1 - x0), abs(y1 - y0))
+    try:
+        info = pdfinfo_from_bytes(data, timeout=timeout)
+    except Exception as ex:
+        print(ex)
+        return None
+    size = PAGE_SIZE.search(info.get("Page size", ""))
+    if "Pages" not in info or size is None:
+        return None
+    return int(info["Pages"]), (float(size.group(1)), float(size.group(2)))
+
+
+def choose_dpi(width, height, target_size=1024, min_dpi=36, max_dpi=300):
+    """
+    DPI such that the largest side of a page of `width` x `height` points
+    is rendered with `target_size` pixels
+    """
+    side = max(width, height)
+    if side <= 0:
+        return max_dpi
+    dpi = target_size * 72 / side
+    return int(round(min(max(dpi, min_dpi), max_dpi)))
+
+
+def rasterize_pdf(data, target_size=1024, min_dpi=36, max_dpi=300, timeout=60):
+    """
+    render a single-page PDF to PNG bytes, with a DPI chosen so that the largest side
+    is about `target_size` pixels.
+    Multi-page PDFs are skipped without being rendered, returns None if the PDF is skipped or can't be rendered.
+    """
+    info = pdf_info(data)
+    if info is None:
+        return None
+    nb_pages, (width, height) = info
+    if nb_pages != 1:
+        return None
+    dpi = choose_dpi(width, height, target_size=target_size, min_dpi=min_dpi, max_dpi=max_dpi)
+    with tempfile.TemporaryDirectory() as folder:
+        try:
+            # poppler writes the PNG directly, no need to decode and re-encode it with PIL
+            paths = convert_from_bytes(
+                data, dpi=dpi, first_page=1, last_page=1, single_file=True,
+                fmt="png", output_folder=folder, paths_only=True, timeout=timeout,
+            )
+        except Exception as ex:
+            print(ex)
+            return None
+        if len(paths) != 1:
+            return None
+        with open(paths[0], "rb") as fd:
+            return fd.read()
+
+
+def scratch_dir():
+    """
+    folder for temporary files, in memory (tmpfs) when possible
+    """
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+class GhostscriptWorker:
+    """
+    a persistent Ghostscript process rendering PostScript/EPS files sent as jobs on its stdin,
+    so that the interpreter is started once instead of once per figure.
+    The process runs with -dSAFER, can only access its own scratch folder, and is limited to
+    `memory_limit` bytes of address space (with `ulimit -v` in the shell starting it, as the
+    rasterization threads make `preexec_fn` unsafe). It is killed (and restarted by the next job)
+    when a job takes more than its timeout.
+    """
+
+    def __init__(self, memory_limit=2 * 1024 ** 3):
+        self.memory_limit = memory_limit
+        self.folder = tempfile.mkdtemp(prefix="gs-", dir=scratch_dir())
+        self.proc = None
+        self.nb_jobs = 0
+        self.buffer = b""
+
+    def start(self):
+        self.proc = subprocess.Popen(
+            [
+                "sh", "-c", 'ulimit -v %d && exec "$@"' % (self.memory_limit // 1024), "sh",
+                "gs", "-q", "-dNOPAUSE", "-dSAFER", f"--permit-file-all={self.folder}/",
+                "-sDEVICE=png16m", "-dTextAlphaBits=4", "-dGraphicsAlphaBits=4",
+                "-sOutputFile=" + os.path.join(self.folder, "page-%d.png"), "-",
+            ],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        )
+        # pages are numbered from 1 by each process
+        self.nb_jobs = 0
+        self.buffer = b""
+
+    def stop(self):
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+
+    def wait(self, job, timeout):
+        # read the output of Ghostscript up to the status line of `job`
+        deadline = time.monotonic() + timeout
+        fd = self.proc.stdout.fileno()
+        while True:
+            lines = self.buffer.split(b"\n")
+            self.buffer = lines.pop()
+            for line in lines:
+                if line == b"%%%%pp-ok %d" % job:
+                    return True
+                if line == b"%%%%pp-error %d" % job:
+                    return False
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise TimeoutError(f"ghostscript job timed out after {timeout}s")
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise OSError("ghostscript exited")
+            self.buffer += chunk
+
+    def render(self, data, target_size=1024, min_dpi=36, max_dpi=300, timeout=60):
+        """
+        render a PostScript or EPS file to PNG bytes, cropped to its bounding box, with a DPI chosen
+        so that the largest side is about `target_size` pixels. Returns None if it can't be rendered.
+        """
+        data = postscript_section(data)
+        x0, y0, x1, y1 = bounding_box(data) or DEFAULT_BOX
+        width, height = abs(x1 - x0), abs(y1 - y0)
+        if width == 0 or height == 0:
+            return None
+        if self.proc is None or self.proc.poll() is not None:
+            self.start()
+        self.nb_jobs += 1
+        job = self.nb_jobs
+        path = os.path.join(self.folder, "job.ps")
+        page = os.path.join(self.folder, f"page-{job}.png")
+        dpi = choose_dpi(width, height, target_size=target_size, min_dpi=min_dpi, max_dpi=max_dpi)
+        try:
+            with open(path, "wb") as fd:
+                fd.write(data)
+            command = GS_JOB % dict(width=width, height=height, dpi=dpi, x0=min(x0, x1), y0=min(y0, y1), path=path, job=job)
+            self.proc.stdin.write(command.encode())
+            self.proc.stdin.flush()
+            ok = self.wait(job, timeout)
+            if not ok:
+                return None
+            with open(page, "rb") as fd:
+                return fd.read()
+        except (OSError, TimeoutError) as ex:
+            print(ex)
+            self.stop()
+            return None
+        finally:
+            for name in (path, page):
+                if os.path.exists(name):
+                    os.remove(name)
+
+    def close(self):
+        self.stop()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def has_ghostscript():
+    return shutil.which("gs") is not None
+
+
+class RasterizerPool:
+    """
+    bounded pool rasterizing PDF figures with poppler, and PostScript/EPS figures with persistent
+    Ghostscript processes: at most `num_workers` figures are rendered at once.
+    Figures are submitted as soon as they are known and rendered in the background while the
+    parsing worker goes on, `submit` returns a future of the PNG bytes (or None).
+    Ghostscript is only used with `ghostscript=True` (and if it is installed), otherwise
+    PostScript/EPS figures are left as they are.
+    """
+
+    def __init__(self, num_workers=4, target_size=1024, min_dpi=36, max_dpi=300, timeout=60, ghostscript=False, gs_memory_limit=2 * 1024 ** 3):
+        self.options = dict(target_size=target_size, min_dpi=min_dpi, max_dpi=max_dpi, timeout=timeout)
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="rasterize")
+        # one Ghostscript process per thread at most, started on first use
+        self.ghostscript = ghostscript and has_ghostscript()
+        self.gs_memory_limit = gs_memory_limit
+        self.gs_workers = queue.Queue()
+        self.gs_all = []
+        self.gs_lock = threading.Lock()
+
+    def rasterize_postscript(self, data):
+        try:
+            worker = self.gs_workers.get_nowait()
+        except queue.Empty:
+            worker = GhostscriptWorker(memory_limit=self.gs_memory_limit)
+            with self.gs_lock:
+                self.gs_all.append(worker)
+        try:
+            return worker.render(data, **self.options)
+        finally:
+            self.gs_workers.put(worker)
+
+    def rasterize(self, data, ext):
+        with timer("rasterize"):
+            if ext in POSTSCRIPT_EXTENSIONS:
+                return self.rasterize_postscript(data)
+            return rasterize_pdf(data, **self.options)
+
+    def submit(self, data, ext=".pdf"):
+        return self.executor.submit(self.rasterize, data, ext)
+
+    def close(self):
+        # the running jobs are finished before their Ghostscript processes are stopped
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        with self.gs_lock:
+            for worker in self.gs_all:
+                worker.close()
+            self.gs_all = []
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_rasterizer(num_workers=4, target_size=1024, **kw):
+    """
+    rasterizer pool of the current process, created on first use
+    (pools are not shared with forked workers) and closed when the process exits
+    """
+    key = (os.getpid(), num_workers, target_size, tuple(sorted(kw.items())))
+    with _pools_lock:
+        if key not in _pools:
+            pool = _pools[key] = RasterizerPool(num_workers=num_workers, target_size=target_size, **kw)
+            # unlike `atexit`, also run when a DataLoader or `stream_map` worker exits,
+            # stops the Ghostscript processes and removes their scratch folders
+            multiprocessing.util.Finalize(pool, pool.close, exitpriority=10)
+        return _pools[key]
@@ -0,0 +1,203 @@
+import os
+import re
+import json
+import sqlite3
+import hashlib
+from collections import OrderedDict
+
+from guard import critical
+
+# network and cluster filesystems, where SQLite's WAL mode (which needs shared memory between
+# the processes using the database) is not supported and can corrupt the database
+NETWORK_FILESYSTEMS = ("nfs", "nfs4", "lustre", "cifs", "smb3", "smbfs", "gpfs", "beegfs", "ceph", "glusterfs", "9p", "fuse")
+
+
+def normalize_latex(math):
+    """
+    normalize an equation before hashing it: runs of whitespace are not significant in math mode
+    (a single space is kept as it can end a control word)
+    """
+    return re.sub(r"\s+", " ", math).strip()
+
+
+def filesystem_type(path):
+    """
+    type of the filesystem holding `path`, from /proc/mounts (None if unknown)
+    """
+    path = os.path.realpath(path)
+    best, fstype = "", None
+    try:
+        with open("/proc/mounts") as fd:
+            for line in fd:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount = fields[1].replace("\\040", " ")
+                if (path == mount or path.startswith(mount.rstrip("/") + "/")) and len(mount) > len(best):
+                    best, fstype = mount, fields[2]
+    except OSError:
+        return None
+    return fstype
+
+
+def journal_mode(path):
+    """
+    SQLite journal mode for a database at `path`: WAL (concurrent readers and writer) on local
+    filesystems, DELETE on network filesystems (and when the filesystem is unknown)
+    """
+    fstype = filesystem_type(os.path.dirname(os.path.abspath(path)))
+    if fstype is None or fstype.split(".")[0] in NETWORK_FILESYSTEMS:
+        return "DELETE"
+    return "WAL"
+
+
+class RenderCache:
+    """
+    content-addressed cache of rendered equations, keyed by the normalized LaTeX and the
+    render settings, so that repeated equations (`$x$`, `$n$`, ...) are rendered only once.
+
+    An in-process LRU holding at most `lru_bytes` bytes of renders sits in front of an optional SQLite store at `path`,
+    shared by all the workers (and runs) using the same path. Failed renders are cached too.
+    The store uses SQLite's WAL mode on local filesystems only, see `journal_mode`: on a network filesystem
+    (e.g. next to the shards of a multi-node run) it is slower, and it must not be shared by several nodes
+    unless the filesystem supports POSIX locks, prefer a node-local path there.
+    """
+
+    def __init__(self, path=None, lru_bytes=64e6, settings=None):
+        self.path = path
+        self.lru_bytes = lru_bytes
+        self.settings = json.dumps(settings or {}, sort_keys=True)
+        self.lru = OrderedDict()
+        self.lru_total = 0
+        self.db = None
+        self.pid = None
+        self.stats = {"memory": 0, "disk": 0, "miss": 0}
+
+    def connect(self):
+        # one connection per process, connections can't be shared with forked workers
+        if self.path is None:
+            return None
+        if self.db is None or self.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with critical():
+                self.db = sqlite3.connect(self.path, timeout=60)
+                self.db.execute(f"PRAGMA journal_mode={journal_mode(self.path)}")
+                self.db.execute("PRAGMA synchronous=NORMAL")
+                self.db.execute("CREATE TABLE IF NOT EXISTS renders (key TEXT PRIMARY KEY, data BLOB)")
+                self.db.commit()
+                self.pid = os.getpid()
+        return self.db
+
+    def key(self, math):
+        return hashlib.sha1((self.settings + "\0" + normalize_latex(math)).encode()).hexdigest()
+
+    def lru_put(self, key, data):
+        if key in self.lru:
+            self.lru_total -= entry_size(key, self.lru.pop(key))
+        self.lru[key] = data
+        self.lru_total += entry_size(key, data)
+        while self.lru_total > self.lru_bytes and self.lru:
+            old_key, old_data = self.lru.popitem(last=False)
+            self.lru_total -= entry_size(old_key, old_data)
+
+    def lookup(self, key):
+        """
+        return (data, where) for a cached render, None otherwise
+        """
+        if key in self.lru:
+            self.lru.move_to_end(key)
+            return self.lru[key], "memory"
+        db = self.connect()
+        if db is not None:
+            row = db.execute("SELECT data FROM renders WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.lru_put(key, row[0])
+                return row[0], "disk"
+        return None
+
+    def store(self, renders):
+        db = self.connect()
+        # not interrupted by the budget of the paper (see `guard.critical`)
+        with critical():
+            for key, data in renders:
+                self.lru_put(key, data)
+            if db is not None and renders:
+                try:
+                    with db:
+                        db.executemany("INSERT OR IGNORE INTO renders (key, data) VALUES (?, ?)", renders)
+                except sqlite3.Error as ex:
+                    print(ex)
+
+    def render(self, math, fn):
+        """
+        return (`fn(math)`, where) with `where` one of "memory", "disk" (cache hits) or "miss"
+        """
+        return self.render_batch([math], lambda maths: [fn(m) for m in maths])[0]
+
+    def render_batch(self, maths, fn):
+        """
+        like `render` for a list of equations, where `fn` renders a list of equations.
+        Equations that are not cached are rendered with a single call to `fn`,
+        each distinct equation only once.
+        """
+        keys = [self.key(math) for math in maths]
+        results = [None] * len(maths)
+        todo = {}
+        for i, key in enumerate(keys):
+            if key in todo:
+                continue
+            cached = self.lookup(key)
+            if cached is None:
+                todo[key] = i
+            else:
+                results[i] = cached
+        rendered = {}
+        if todo:
+            rendered = dict(zip(todo, fn([maths[i] for i in todo.values()])))
+            self.store(list(rendered.items()))
+            for key, i in todo.items():
+                results[i] = rendered[key], "miss"
+        for i, key in enumerate(keys):
+            if results[i] is None:
+                # repeated in the batch
+                results[i] = rendered[key], "memory"
+        for data, where in results:
+            self.stats[where] += 1
+        return results
+
+
+def entry_size(key, data):
+    """
+    approximate size of an LRU entry, failed renders (None) only cost their key
+    """
+    return len(key) + (len(data) if data is not None else 0)
+
+
+_caches = {}
+
+
+def get_render_cache(path=None, lru_bytes=64e6, settings=None):
+    """
+    render cache of the current process for a given store
+    """
+    key = (path, lru_bytes, json.dumps(settings or {}, sort_keys=True))
+    if key not in _caches:
+        _caches[key] = RenderCache(path, lru_bytes=lru_bytes, settings=settings)
+    return _caches[key]
+
+
+def print_cache_report(counts, bytes_saved, failed=None):
+    """
+    `counts` maps "memory", "disk" and "miss" to numbers of successful renders,
+    `failed` to numbers of failed renders (a cached failure is not rendered again)
+    """
+    failed = failed or {}
+    nb_failed = sum(failed.values())
+    counts = {where: nb + failed.get(where, 0) for where, nb in counts.items()}
+    total = sum(counts.values())
+    if not total:
+        return
+    hits = counts["memory"] + counts["disk"]
+    print(f"Render cache: hit rate {100*hits/total:.1f}% ({counts['memory']} in memory, {counts['disk']} on disk, {counts['miss']} rendered), {bytes_saved/1e6:.1f} MB not re-rendered")
+    if nb_failed:
+        print(f"Render cache: {nb_failed} failed renders ({100*nb_failed/total:.1f}%, {nb_failed - failed.get('miss', 0)} of them cached failures), not written")
@@ -0,0 +1,298 @@
+import os
+import time
+import queue
+import math
+import itertools
+import collections
+import hashlib
+import multiprocessing
+import multiprocessing.connection
+import torch
+from metrics import stats_record
+
+# how often workers send their metrics to the main process, in seconds
+METRICS_INTERVAL = 10
+# end of the items of `stream_map`
+_END = object()
+
+
+def get_rank(rank=None, world_size=None):
+    """
+    return (rank, world_size), taken from SLURM (SLURM_PROCID/SLURM_NTASKS) when not given
+    """
+    if rank is None:
+        rank = int(os.environ.get("SLURM_PROCID", 0))
+    if world_size is None:
+        world_size = int(os.environ.get("SLURM_NTASKS", 1))
+    assert 0 <= rank < world_size, (rank, world_size)
+    return rank, world_size
+
+
+def partition(items, rank, world_size):
+    """
+    deterministic hash partitioning of `items` between `world_size` ranks,
+    independent of the order of `items` and of the Python hash seed
+    """
+    if world_size == 1:
+        return list(items)
+    return [
+        item for item in items
+        if int(hashlib.md5(item.encode()).hexdigest(), 16) % world_size == rank
+    ]
+
+
+class WorkQueue:
+    """
+    shared queue of input files that DataLoader workers pull from one at a time,
+    so that cheap and expensive files are balanced dynamically between workers.
+    It also keeps track of how busy each worker was.
+    """
+
+    def __init__(self, items, num_workers, ctx=None):
+        ctx = ctx if ctx is not None else multiprocessing.get_context()
+        self.num_workers = max(num_workers, 1)
+        self.queue = ctx.Queue()
+        for item in items:
+            self.queue.put(item)
+        # one end marker per worker
+        for _ in range(self.num_workers):
+            self.queue.put(None)
+        self.nb_files = ctx.Array('i', self.num_workers)
+        self.busy = ctx.Array('d', self.num_workers)
+        self.finished = ctx.Array('d', self.num_workers)
+        self.t0 = time.time()
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            t0 = time.time()
+            yield item
+            with self.busy.get_lock():
+                self.busy[worker_id] += time.time() - t0
+            with self.nb_files.get_lock():
+                self.nb_files[worker_id] += 1
+        self.finished[worker_id] = time.time()
+
+    def close(self):
+        # do not block at exit on items that were never consumed
+        self.queue.cancel_join_thread()
+        self.queue.close()
+
+    def report(self):
+        """
+        return per-worker utilization, as the fraction of wall-clock time spent processing files
+        """
+        wall = time.time() - self.t0
+        stats = []
+        for i in range(self.num_workers):
+            finished = self.finished[i] - self.t0 if self.finished[i] else wall
+            stats.append({
+                "worker": i,
+                "files": self.nb_files[i],
+                "busy": self.busy[i],
+                "finished": finished,
+                "utilization": self.busy[i] / wall if wall else 0.0,
+            })
+        return stats
+
+    def print_report(self):
+        for s in self.report():
+            print(f"Worker {s['worker']}: {s['files']} files, busy {s['busy']:.1f}s, done after {s['finished']:.1f}s, utilization {100*s['utilization']:.1f}%")
+
+
+class QueuedDataset(torch.utils.data.IterableDataset):
+    """
+    apply a parsing function (a generator of samples) to every file pulled from a `WorkQueue`
+    """
+
+    def __init__(self, fn, queue, **kw):
+        super().__init__()
+        self.fn = fn
+        self.queue = queue
+        self.kw = kw
+
+    def __iter__(self):
+        for fs in self.queue:
+            yield from tag_source(self.fn, fs, **self.kw)
+
+
+def tag_source(fn, item, **kw):
+    """
+    yield the samples of `fn(item)`, each tagged with the item it comes from (`__source__`),
+    followed by a `{"__done__": item}` marker once `item` is fully processed, or by a
+    `{"__failed__": item, "error": ...}` record if `fn` raised, so that the item is not recorded
+    as done (and a resumed extraction processes it again).
+    The metrics recorded by the worker (see `metrics.py`) are sent along, as
+    `{"__stats__": {"metrics": ...}}` records, every `METRICS_INTERVAL` seconds and at the end of `item`.
+    """
+    last = time.time()
+    try:
+        for sample in fn(item, **kw):
+            sample["__source__"] = item
+            yield sample
+            if time.time() - last > METRICS_INTERVAL:
+                last = time.time()
+                yield stats_record()
+    except Exception as ex:
+        print(f"Failed {item}: {ex}")
+        yield stats_record()
+        yield {"__failed__": item, "error": f"{type(ex).__name__}: {ex}"}
+        return
+    yield stats_record()
+    yield {"__done__": item}
+
+
+def _stream_worker(fn, kw, tasks, results, chunk_size, started):
+    while True:
+        item = tasks.get()
+        if item is None:
+            break
+        # known by the parent even if the worker dies
+        started.value += 1
+        chunk = []
+        for sample in tag_source(fn, item, **kw):
+            chunk.append(sample)
+            if len(chunk) == chunk_size:
+                results.send(chunk)
+                chunk = []
+        results.send(chunk)
+
+
+def stream_map(fn, items, num_workers, window=None, chunk_size=16, max_chunks=None, ctx=None, **kw):
+    """
+    apply a parsing function (a generator of samples) to every item using `num_workers` processes,
+    and yield the samples as soon as they are produced (see `tag_source` for their format).
+
+    At most `window` items (default: 2 x num_workers) are in flight at any time, spread evenly over
+    the workers (each one has its own queue of items), a new one is submitted as soon as any of them completes.
+    Samples are sent back to the parent in chunks of `chunk_size`, through a pipe per worker,
+    and at most `max_chunks` chunks are waiting in the parent at any time (workers block otherwise),
+    which bounds the parent's memory.
+
+    A worker that dies (e.g. killed for using too much memory) is replaced: the item it was
+    processing (and any item whose last samples were lost with it) is reported with a
+    `{"__failed__": item, "error": ...}` record, and the items waiting in its queue are submitted again.
+    """
+    if num_workers == 0:
+        for item in items:
+            yield from tag_source(fn, item, **kw)
+        return
+    ctx = ctx if ctx is not None else multiprocessing.get_context()
+    window = window if window is not None else 2 * num_workers
+    max_chunks = max_chunks if max_chunks is not None else 4 * num_workers
+    per_worker = max(math.ceil(window / num_workers), 1)
+    # token -> {"process", "tasks": queue of its items, "results": pipe of its samples,
+    # "assigned": its items not completed yet in order, "started": nb of items it started, "completed"}
+    workers = {}
+    tokens = itertools.count()
+    items = iter(items)
+    # items of dead workers that were not started
+    retry = collections.deque()
+    # (token, chunk) received and not yielded yet
+    buffer = collections.deque()
+
+    def start_worker():
+        tasks = ctx.Queue()
+        results, results_writer = ctx.Pipe(duplex=False)
+        started = ctx.Value("i", 0, lock=False)
+        w = ctx.Process(target=_stream_worker, args=(fn, kw, tasks, results_writer, chunk_size, started), daemon=True)
+        w.start()
+        # only the worker writes to it, so that reading it fails once the worker is dead
+        results_writer.close()
+        workers[next(tokens)] = {"process": w, "tasks": tasks, "results": results, "assigned": collections.deque(), "started": started, "completed": 0}
+
+    def submit():
+        while True:
+            worker = min(workers.values(), key=lambda w: len(w["assigned"]))
+            if len(worker["assigned"]) >= per_worker:
+                return
+            if retry:
+                item = retry.popleft()
+            else:
+                item = next(items, _END)
+                if item is _END:
+                    return
+            worker["assigned"].append(item)
+            worker["tasks"].put(item)
+
+    def receive(timeout):
+        """
+        move the chunks that are ready to `buffer`, return False if a worker seems dead
+        """
+        pipes = {w["results"]: token for token, w in workers.items()}
+        alive = True
+        for pipe in multiprocessing.connection.wait(list(pipes), timeout=timeout):
+            try:
+                buffer.append((pipes[pipe], pipe.recv()))
+            except (EOFError, OSError):
+                alive = False
+        return alive
+
+    def handle(token, chunk):
+        for sample in chunk:
+            yield sample
+            # the last record of an item, see `tag_source`
+            if ("__done__" in sample or "__failed__" in sample) and token in workers:
+                workers[token]["assigned"].popleft()
+                workers[token]["completed"] += 1
+                submit()
+
+    def replace_dead_workers():
+        dead = [token for token, w in workers.items() if w["process"].exitcode is not None]
+        if not dead:
+            return
+        # the last samples of the dead workers are handled first
+        for token in dead:
+            pipe = workers[token]["results"]
+            try:
+                while pipe.poll():
+                    buffer.append((token, pipe.recv()))
+            except (EOFError, OSError):
+                pass
+        while buffer:
+            yield from handle(*buffer.popleft())
+        for token in dead:
+            worker = workers.pop(token)
+            w = worker["process"]
+            worker["results"].close()
+            worker["tasks"].cancel_join_thread()
+            worker["tasks"].close()
+            start_worker()
+            assigned = worker["assigned"]
+            failed = [assigned.popleft() for _ in range(min(worker["started"].value - worker["completed"], len(assigned)))]
+            if failed:
+                print(f"stream_map worker {w.pid} died with exit code {w.exitcode} while processing {failed[-1]}")
+            for item in failed:
+                yield {"__failed__": item, "error": f"worker died with exit code {w.exitcode}"}
+            # not started yet
+            retry.extendleft(reversed(assigned))
+        submit()
+
+    for _ in range(num_workers):
+        start_worker()
+    try:
+        submit()
+        last_check = time.time()
+        while any(w["assigned"] for w in workers.values()):
+            alive = True
+            if len(buffer) < max_chunks:
+                alive = receive(timeout=0 if buffer else 1)
+            if buffer:
+                yield from handle(*buffer.popleft())
+            if not alive or time.time() - last_check > 1:
+                last_check = time.time()
+                yield from replace_dead_workers()
+        for w in workers.values():
+            w["tasks"].put(None)
+        for w in workers.values():
+            w["process"].join()
+    finally:
+        for w in workers.values():
+            if w["process"].is_alive():
+                w["process"].terminate()
+            w["tasks"].cancel_join_thread()
+            w["results"].close()
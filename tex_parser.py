@@ -0,0 +1,360 @@
+"""
+Lightweight LaTeX parser for figure environments.
+
+It builds the same tree as TexSoup (same tokenization, same argument parsing,
+same string representation of nodes) for the subset of LaTeX found in figures,
+in a single linear pass and without TexSoup's per-character object overhead.
+Anything outside of that subset (comments, \\item, verbatim-like environments,
+malformed input, ...) raises `Unsupported`, callers are expected to fall back to TexSoup.
+"""
+import string
+
+LETTERS = frozenset(string.ascii_letters)
+# characters that are neither "letters" nor "others" for TexSoup
+SPECIAL = frozenset("\\{}$&\n\r#^_ \t~%[]()\x00\x7f")
+# characters that end a run of text
+TEXT_END = frozenset("\\{}$[]%")
+
+SKIP_ENV_NAMES = ('lstlisting', 'verbatim', 'verbatimtab', 'Verbatim', 'listing')
+
+SIGNATURES = {
+    'def': (2, 0),
+    'textbf': (1, 0),
+    'section': (1, 1),
+    'label': (1, 0),
+    'cap': (0, 0),
+    'cup': (0, 0),
+    'in': (0, 0),
+    'notin': (0, 0),
+    'infty': (0, 0),
+    'noindent': (0, 0),
+}
+
+BRACKETS_DELIMITERS = {
+    '(', ')', '<', '>', '[', ']', '{', '}', r'\{', r'\}', '.', '|', r'\langle',
+    r'\rangle', r'\lfloor', r'\rfloor', r'\lceil', r'\rceil', r'\ulcorner',
+    r'\urcorner', r'\lbrack', r'\rbrack'
+}
+SIZE_PREFIX = ('left', 'right', 'big', 'Big', 'bigg', 'Bigg')
+PUNCTUATION_COMMANDS = {command + bracket
+                        for command in SIZE_PREFIX
+                        for bracket in BRACKETS_DELIMITERS.union({'|', '.'})}
+
+# token kinds
+TEXT = 0
+SPACER = 1
+ESCAPE = 2
+COMMAND_NAME = 3
+GROUP_BEGIN = 4
+GROUP_END = 5
+BRACKET_BEGIN = 6
+BRACKET_END = 7
+MATH_SWITCH = 8
+DISPLAY_MATH_SWITCH = 9
+MATH_GROUP_BEGIN = 10
+MATH_GROUP_END = 11
+DISPLAY_MATH_GROUP_BEGIN = 12
+DISPLAY_MATH_GROUP_END = 13
+
+SYMBOLS = {
+    '\\': ESCAPE,
+    '{': GROUP_BEGIN,
+    '}': GROUP_END,
+    '[': BRACKET_BEGIN,
+    ']': BRACKET_END,
+}
+MATH_GROUPS = {
+    '[': DISPLAY_MATH_GROUP_BEGIN,
+    ']': DISPLAY_MATH_GROUP_END,
+    '(': MATH_GROUP_BEGIN,
+    ')': MATH_GROUP_END,
+}
+# begin token -> (end token, name, begin, end)
+MATH_ENVS = {
+    MATH_SWITCH: (MATH_SWITCH, '$', '$', '$'),
+    DISPLAY_MATH_SWITCH: (DISPLAY_MATH_SWITCH, '$$', '$$', '$$'),
+    MATH_GROUP_BEGIN: (MATH_GROUP_END, 'math', '\\(', '\\)'),
+    DISPLAY_MATH_GROUP_BEGIN: (DISPLAY_MATH_GROUP_END, 'displaymath', '\\[', '\\]'),
+}
+
+
+class Unsupported(Exception):
+    pass
+
+
+def tokenize(s):
+    """
+    split `s` into (kind, text) tokens, following TexSoup's tokenizer
+    """
+    tokens = []
+    n = len(s)
+    i = 0
+    while i < n:
+        c = s[i]
+        nxt = s[i + 1] if i + 1 < n else None
+        if c == '\\' and nxt is not None and nxt not in LETTERS and nxt not in '[]()\x00\x7f':
+            # escaped symbol, including line breaks
+            tokens.append((TEXT, s[i:i + 2]))
+            i += 2
+            continue
+        if c == '%':
+            raise Unsupported("comment")
+        if c == '$':
+            if nxt == '$':
+                tokens.append((DISPLAY_MATH_SWITCH, '$$'))
+                i += 2
+            else:
+                tokens.append((MATH_SWITCH, '$'))
+                i += 1
+            continue
+        if c == '\\' and nxt is not None and nxt in MATH_GROUPS:
+            tokens.append((MATH_GROUPS[nxt], s[i:i + 2]))
+            i += 2
+            continue
+        if c in '\x00\x7f':
+            raise Unsupported("ignored character")
+        if c in ' \t\n\r':
+            j = i
+            while j < n and s[j] in ' \t':
+                j += 1
+            if j < n and s[j] in '\n\r':
+                j += 1
+            while j < n and s[j] in ' \t':
+                j += 1
+            if j > i and (j == n or s[j] in SPECIAL):
+                tokens.append((SPACER, s[i:j]))
+                i = j
+                continue
+        if c in SYMBOLS:
+            if c == '\\' and nxt is None:
+                raise Unsupported("trailing backslash")
+            tokens.append((SYMBOLS[c], c))
+            i += 1
+            continue
+        if i > 0 and s[i - 1] == '\\':
+            points = ()
+            if s.startswith(SIZE_PREFIX, i):
+                points = {p for p in PUNCTUATION_COMMANDS if s.startswith(p, i)}
+            if len(points) > 1:
+                raise Unsupported("ambiguous punctuation command")
+            if points:
+                point = points.pop()
+                tokens.append((COMMAND_NAME, point))
+                i += len(point)
+                continue
+            if c in LETTERS:
+                j = i + 1
+                while j < n and (s[j] in LETTERS or s[j] == '*'):
+                    j += 1
+                tokens.append((COMMAND_NAME, s[i:j]))
+                i = j
+                continue
+        j = i + 1
+        while j < n and s[j] not in TEXT_END:
+            j += 1
+        tokens.append((TEXT, s[i:j]))
+        i = j
+    return tokens
+
+
+class Node:
+    """
+    a command, environment, group or math environment,
+    exposing the parts of TexSoup's `TexNode` interface used to extract figures
+    """
+
+    __slots__ = ("name", "begin", "end", "args", "_contents", "parent", "is_command")
+
+    def __init__(self, name, begin="", end="", args=(), contents=(), is_command=False):
+        self.name = name.strip()
+        self.begin = begin
+        self.end = end
+        self.args = list(args)
+        self._contents = list(contents)
+        self.parent = None
+        self.is_command = is_command
+        for child in self.children:
+            child.parent = self
+
+    def all(self):
+        for arg in self.args:
+            for expr in arg._contents:
+                if not (isinstance(expr, str) and expr.isspace()):
+                    yield expr
+        yield from self._contents
+
+    def __iter__(self):
+        for expr in self.all():
+            if not (isinstance(expr, str) and expr.isspace()):
+                yield expr
+
+    @property
+    def contents(self):
+        return list(self)
+
+    @property
+    def children(self):
+        return [expr for expr in self.all() if isinstance(expr, Node)]
+
+    @property
+    def string(self):
+        return "".join(map(str, self._contents))
+
+    def __str__(self):
+        args = "".join(map(str, self.args))
+        if self.is_command:
+            return "\\" + self.name + args
+        return self.begin + args + "".join(map(str, self._contents)) + self.end
+
+    def __repr__(self):
+        return str(self)
+
+
+class Parser:
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos][0]
+        return None
+
+    def next(self):
+        if self.pos >= len(self.tokens):
+            raise Unsupported("unexpected end of input")
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def read_tex(self):
+        contents = []
+        while self.pos < len(self.tokens):
+            contents.append(self.read_expr())
+        return Node("[tex]", contents=contents)
+
+    def read_expr(self):
+        kind, text = self.next()
+        if kind in MATH_ENVS:
+            return self.read_math_env(kind)
+        if kind == ESCAPE:
+            name, args = self.read_command()
+            if name == "item":
+                raise Unsupported("item")
+            if name == "begin":
+                if not args:
+                    raise Unsupported("begin without name")
+                env_name = args[0].string.strip()
+                if env_name in SKIP_ENV_NAMES:
+                    raise Unsupported("skipped environment")
+                contents = self.read_env(env_name)
+                return Node(
+                    env_name, r"\begin{%s}" % env_name, r"\end{%s}" % env_name,
+                    args=args[1:], contents=contents,
+                )
+            return Node(name, args=args, is_command=True)
+        if kind == GROUP_BEGIN:
+            return self.read_arg(GROUP_BEGIN)
+        return text
+
+    def read_math_env(self, kind):
+        end_kind, name, begin, end = MATH_ENVS[kind]
+        contents = []
+        while self.pos < len(self.tokens) and self.peek() != end_kind:
+            contents.append(self.read_expr())
+        if self.pos >= len(self.tokens):
+            raise Unsupported("unclosed math")
+        self.pos += 1
+        return Node(name, begin, end, contents=contents)
+
+    def read_env(self, name):
+        contents = []
+        while self.pos < len(self.tokens):
+            if (
+                self.peek() == ESCAPE
+                and self.pos + 1 < len(self.tokens)
+                and self.tokens[self.pos + 1][1] == "end"
+            ):
+                # skip `\end` and its single argument, the groups after it are not arguments
+                self.pos += 2
+                args = []
+                self.read_arg_required(args, 1)
+                if not args or args[0].string != name:
+                    raise Unsupported("mismatched environment")
+                return contents
+            contents.append(self.read_expr())
+        raise Unsupported("unclosed environment")
+
+    def read_command(self):
+        kind, name = self.next()
+        n_required, n_optional = SIGNATURES.get(name, (-1, -1))
+        return name, self.read_args(n_required, n_optional)
+
+    def read_args(self, n_required, n_optional):
+        args = []
+        if n_required == 0 and n_optional == 0:
+            return args
+        n_optional = self.read_arg_optional(args, n_optional)
+        n_required = self.read_arg_required(args, n_required)
+        if self.peek() == BRACKET_BEGIN:
+            n_optional = self.read_arg_optional(args, n_optional)
+        if self.peek() == GROUP_BEGIN:
+            n_required = self.read_arg_required(args, n_required)
+        return args
+
+    def read_spacer(self):
+        if self.peek() == SPACER:
+            self.pos += 1
+            return True
+        return False
+
+    def read_arg_optional(self, args, n_optional):
+        while n_optional != 0:
+            spacer = self.read_spacer()
+            if self.peek() != BRACKET_BEGIN:
+                if spacer:
+                    self.pos -= 1
+                break
+            self.pos += 1
+            args.append(self.read_arg(BRACKET_BEGIN))
+            n_optional -= 1
+        return n_optional
+
+    def read_arg_required(self, args, n_required):
+        while n_required != 0 and self.pos < len(self.tokens):
+            spacer = self.read_spacer()
+            if self.peek() == GROUP_BEGIN:
+                self.pos += 1
+                args.append(self.read_arg(GROUP_BEGIN))
+                n_required -= 1
+                continue
+            elif self.pos < len(self.tokens) and n_required > 0:
+                raise Unsupported("argument without braces")
+            if spacer:
+                self.pos -= 1
+            break
+        return n_required
+
+    def read_arg(self, kind):
+        if kind == GROUP_BEGIN:
+            end_kind, name, begin, end = GROUP_END, "BraceGroup", "{", "}"
+        else:
+            end_kind, name, begin, end = BRACKET_END, "BracketGroup", "[", "]"
+        contents = []
+        while self.pos < len(self.tokens):
+            if self.peek() == end_kind:
+                self.pos += 1
+                return Node(name, begin, end, contents=contents)
+            contents.append(self.read_expr())
+        raise Unsupported("unclosed argument")
+
+
+def parse(text):
+    """
+    parse `text` into a tree of `Node`, raises `Unsupported` if TexSoup should be used instead
+    """
+    try:
+        return Parser(tokenize(text)).read_tex()
+    except RecursionError:
+        raise Unsupported("too deeply nested")
@@ -0,0 +1,118 @@
+"""
+Resolution of multi-file LaTeX projects: the root document is found, and the files it
+includes are expanded in place, so that the rest of the pipeline sees a paper as a single
+source (with the \\graphicspath of the root applying to figures in included files) and
+.tex files that are not part of the paper (old versions, unused drafts) are ignored.
+"""
+import re
+import posixpath
+
+# a comment and its end of line, which is kept if the next line is blank (a paragraph break)
+COMMENT = re.compile(r"(\\[\\%])|%[^\n]*(?:\n(?![ \t]*\n))?")
+DOCUMENTCLASS = re.compile(r"\\documentclass\s*(?:\[[^\]]*\])?\s*\{\s*([^{}\s]*)\s*\}")
+BEGIN_DOCUMENT = re.compile(r"\\begin\s*\{document\}")
+INCLUDE = re.compile(r"\\(input|include|subfile)\s*(?:\{([^{}]*)\}|\s([^\s{}\\%]+))")
+MAX_DEPTH = 20
+
+
+def strip_comments(data):
+    """
+    remove comments with their end of line, unless the next line is blank
+    """
+    if "%" not in data:
+        return data
+    return COMMENT.sub(lambda m: m.group(1) or "", data)
+
+
+class Project:
+    """
+    the .tex files of a paper, `sources` mapping file names to their (decoded) contents
+    """
+
+    def __init__(self, sources):
+        self.sources = {}
+        for name, data in sources.items():
+            self.sources[posixpath.normpath(name.replace("\\", "/")).lstrip("/")] = strip_comments(data)
+        self.used = set()
+
+    def lookup(self, name, folder):
+        name = name.strip().strip('"')
+        for base in (folder, ""):
+            path = posixpath.normpath(posixpath.join(base, name)).lstrip("/")
+            for candidate in (path, path + ".tex"):
+                if candidate in self.sources:
+                    return candidate
+        return None
+
+    def expand(self, name, folder="", depth=0, stack=()):
+        """
+        contents of `name` with its \\input, \\include and \\subfile expanded.
+        Paths are relative to the folder of the root document (`folder`), like LaTeX does,
+        except for \\subfile which is relative to the including file.
+        """
+        self.used.add(name)
+        data = self.sources[name]
+        if depth == MAX_DEPTH:
+            return data
+        stack = stack + (name,)
+
+        def replace(m):
+            command, path = m.group(1), m.group(2) if m.group(2) is not None else m.group(3)
+            base = posixpath.dirname(name) if command == "subfile" else folder
+            included = self.lookup(path, base)
+            if included is None or included in stack:
+                return m.group(0)
+            contents = self.expand(included, folder, depth + 1, stack)
+            if command == "subfile":
+                contents = body(contents)
+            return contents + "\n" if command == "include" else contents
+        return INCLUDE.sub(replace, data)
+
+    def roots(self):
+        """
+        names of the files that can be compiled on their own (\\documentclass and \\begin{document}),
+        the `subfiles` class excepted
+        """
+        names = []
+        for name, data in sorted(self.sources.items()):
+            m = DOCUMENTCLASS.search(data)
+            if m and m.group(1) != "subfiles" and BEGIN_DOCUMENT.search(data):
+                names.append(name)
+        return names
+
+    def resolve(self):
+        """
+        return the source of the paper: the expansion of its root document, the largest one if there
+        are several (e.g. an old version left next to the main file).
+        Without any root, all the files are concatenated.
+        """
+        best = None
+        for name in self.roots():
+            self.used = set()
+            data = self.expand(name, posixpath.dirname(name))
+            if best is None or len(data) > len(best[0]):
+                best = data, self.used
+        if best is None:
+            self.used = set(self.sources)
+            return "\n".join(self.sources.values())
+        data, self.used = best
+        return data
+
+
+def body(data):
+    # contents of the document environment of a \subfile
+    m = BEGIN_DOCUMENT.search(data)
+    if m is None:
+        return data
+    end = data.rfind("\\end{document}")
+    return data[m.end():end if end >= 0 else len(data)]
+
+
+def resolve_project(sources):
+    """
+    return (source of the paper, names of the .tex files it is made of) for the .tex files `sources`
+    (a dict of file name to contents), comments being removed
+    """
+    project = Project(sources)
+    data = project.resolve()
+    return data, sorted(project.used)
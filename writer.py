@@ -9,6 +9,7 @@
 import io
 import json
 import pickle
+import random
 import re
 import tarfile
 import time
@@ -462,3 +463,146 @@ class ShardWriter:
     def __exit__(self, *args, **kw):
         """Exit context."""
         self.close()
+
+
+class ShardWriterPool:
+    """Like ShardWriter but spreads samples over several shards open at once.
+
+    Shard numbers come from a single counter: at most `nb_open` shards are open at
+    any time, and each of them rolls over to the next free number once it reaches
+    `maxcount` records or `maxsize` bytes. Shards are opened with fsspec, so the
+    pattern can point to object storage.
+    """
+
+    def __init__(
+        self,
+        pattern: str,
+        nb_open: int = 1,
+        maxcount: int = 100000,
+        maxsize: float = 3e9,
+        shuffle_buffer: int = 0,
+        post: Optional[Callable] = None,
+        on_write: Optional[Callable] = None,
+        start_shard: int = 0,
+        end_shard: Optional[int] = None,
+        seed: Optional[int] = None,
+        **kw,
+    ):
+        """Create a ShardWriterPool.
+
+        :param pattern: output file pattern, e.g. "out/shard-%05d.tar"
+        :param nb_open: number of shards written to concurrently (Default value = 1)
+        :param maxcount: maximum number of records per shard (Default value = 100000)
+        :param maxsize: maximum size of each shard (Default value = 3e9)
+        :param shuffle_buffer: number of samples buffered and written in random order (Default value = 0)
+        :param post: called with the name of each shard once it is closed
+        :param on_write: called with each sample and the name of the shard it was written to
+        :param start_shard: first shard number
+        :param end_shard: shard numbers must stay below this value (Default value = None)
+        :param seed: seed of the shuffle buffer
+        :param kw: other options passed to TarWriter
+        """
+        assert nb_open >= 1, nb_open
+        self.verbose = 1
+        self.kw = kw
+        self.pattern = pattern
+        self.maxcount = maxcount
+        self.maxsize = maxsize
+        self.shuffle_buffer = shuffle_buffer
+        self.post = post
+        self.on_write = on_write
+        self.shard = start_shard
+        self.end_shard = end_shard
+        self.rng = random.Random(seed)
+        self.buffer = []
+        self.slots = [None] * nb_open
+        self.next_slot = 0
+        self.total = 0
+
+    def open_shard(self):
+        """Open the next shard number."""
+        if self.end_shard is not None and self.shard >= self.end_shard:
+            raise ValueError(f"shard number {self.shard} is out of range (end_shard={self.end_shard})")
+        import fsspec
+
+        fname = self.pattern % self.shard
+        self.shard += 1
+        if self.verbose:
+            print("# writing", fname, self.total)
+        stream = fsspec.open(fname, "wb").open()
+        return {
+            "fname": fname,
+            "stream": stream,
+            "tarstream": TarWriter(stream, **self.kw),
+            "count": 0,
+            "size": 0,
+        }
+
+    def finish_shard(self, slot):
+        """Close a shard."""
+        slot["tarstream"].close()
+        slot["stream"].close()
+        if callable(self.post):
+            self.post(slot["fname"])
+
+    def write(self, obj):
+        """Write a sample.
+
+        With a shuffle buffer, the sample is buffered and a random buffered
+        sample is written instead once the buffer is full.
+
+        :param obj: sample to be written
+        """
+        if self.shuffle_buffer > 0:
+            self.buffer.append(obj)
+            if len(self.buffer) < self.shuffle_buffer:
+                return
+            i = self.rng.randrange(len(self.buffer))
+            self.buffer[i], self.buffer[-1] = self.buffer[-1], self.buffer[i]
+            obj = self.buffer.pop()
+        self.write_now(obj)
+
+    def write_now(self, obj):
+        """Write a sample to the next shard, bypassing the shuffle buffer.
+
+        :param obj: sample to be written
+        :returns: name of the shard the sample went to
+        """
+        i = self.next_slot
+        self.next_slot = (self.next_slot + 1) % len(self.slots)
+        slot = self.slots[i]
+        if slot is not None and (
+            slot["count"] >= self.maxcount or slot["size"] >= self.maxsize
+        ):
+            self.finish_shard(slot)
+            slot = None
+        if slot is None:
+            slot = self.slots[i] = self.open_shard()
+        slot["size"] += slot["tarstream"].write(obj)
+        slot["count"] += 1
+        self.total += 1
+        if callable(self.on_write):
+            self.on_write(obj, slot["fname"])
+        return slot["fname"]
+
+    def flush(self):
+        """Write all the buffered samples."""
+        self.rng.shuffle(self.buffer)
+        while self.buffer:
+            self.write_now(self.buffer.pop())
+
+    def close(self):
+        """Flush the buffer and close all the open shards."""
+        self.flush()
+        for i, slot in enumerate(self.slots):
+            if slot is not None:
+                self.finish_shard(slot)
+                self.slots[i] = None
+
+    def __enter__(self):
+        """Enter context."""
+        return self
+
+    def __exit__(self, *args, **kw):
+        """Exit context."""
+        self.close()